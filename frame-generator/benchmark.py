@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Frame Generator
+#
+# Copyright (C) 2016 Juliette Lonij, Koninklijke Bibliotheek -
+# National Library of the Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import BaseHTTPServer
+import documents
+import frames
+import frogclient
+import generator
+import json
+import keywords
+import models
+import multiprocessing
+import numpy
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import zlib
+
+TAGS = ['N', 'WW', 'ADJ', 'BW', 'SPEC']
+
+# Syllables of synthetic Dutch-like words
+SYLLABLES = ['de', 'het', 'een', 'van', 'ver', 'ge', 'be', 'ont', 'aar',
+        'oe', 'ij', 'ui', 'sch', 'st', 'ing', 'en', 'lijk', 'heid', 'baar',
+        'kr', 'ma', 'ne', 'to', 'wa', 'zo']
+
+# Benchmark scales as number of documents and document length
+SCALES = [(100, 200), (1000, 200), (5000, 200)]
+
+# Frame generation engines
+FRAME_ENGINES = ['index', 'numpy']
+
+# Gensim LDA training configurations, the first is the original one
+TOPIC_CONFIGS = [
+    ('default', {}),
+    ('chunked', {'chunksize': 2000, 'eval_every': 0}),
+    ('passes', {'chunksize': 2000, 'eval_every': 0, 'passes': 10,
+            'convergence': 0.001}),
+    ('multicore', {'chunksize': 2000, 'eval_every': 0,
+            'workers': multiprocessing.cpu_count()}),
+]
+
+# Keyword and frame arguments of the parameter sweep check
+SWEEP_GRID = ['kcount=5,20', 'ktags=all,N', 'wdir=left,both', 'wsize=3,5',
+        'ftags=all,ADJ+WW']
+
+
+def create_lemmas(num_lemmas, random):
+    '''
+    Create list of unique Dutch-like words.
+    '''
+    lemmas = []
+    seen = set()
+    while len(lemmas) < num_lemmas:
+        lemma = ''.join(random.choice(SYLLABLES, random.randint(1, 5)))
+        if lemma not in seen:
+            seen.add(lemma)
+            lemmas.append(lemma)
+    return lemmas
+
+
+def create_corpus(dir_name, num_docs, doc_length=200, num_lemmas=20000,
+        seed=1, skew=1.2, text=False):
+    '''
+    Create input directory with synthetic pos-tagged documents, or with
+    plain text documents of sentences if text is set.
+
+    Lemmas follow a Zipf distribution, like words in natural language.
+    Lower skew values give a flatter distribution.
+    '''
+    random = numpy.random.RandomState(seed)
+    for sub_dir in ['docs', 'stop', 'regex']:
+        os.makedirs(dir_name + os.sep + sub_dir)
+
+    lemmas = create_lemmas(num_lemmas, random)
+    tags = [TAGS[i % len(TAGS)] for i in range(num_lemmas)]
+    docs = []
+    for i in range(num_docs):
+        ids = (random.zipf(skew, doc_length) - 1) % num_lemmas
+        if text:
+            words = [lemmas[j] for j in ids]
+            sentences = [words[j:j + 15] for j in range(0, len(words), 15)]
+            doc = ' '.join([' '.join(s).capitalize() + '.' for s in
+                    sentences])
+            with open(dir_name + os.sep + 'docs' + os.sep + 'doc' +
+                    str(i).zfill(6) + '.txt', 'w') as f:
+                f.write(doc)
+        else:
+            docs.append([lemmas[j] + '/' + tags[j] for j in ids])
+    if not text:
+        with open(dir_name + os.sep + 'docs' + os.sep + 'docs.json',
+                'w') as f:
+            json.dump({'docs': docs}, f)
+
+    # Most frequent lemmas are stop words
+    with open(dir_name + os.sep + 'stop' + os.sep + 'stop.txt', 'w') as f:
+        f.write('\n'.join(lemmas[:20]))
+
+
+class FrogHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Stand-in for the Frog web service, tagging words with fake tags.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def tag(self, text):
+        '''
+        Get lemma and tag of each word.
+        '''
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        words = [w.strip('.').lower() for w in text.split()]
+        return [(w, TAGS[zlib.crc32(w.encode('utf-8')) % len(TAGS)]) for w in
+                words if w]
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        text = query.get('text', [''])[0].decode('utf-8')
+        self.respond(''.join(['\t'.join([str(i + 1), lemma, lemma, '[' +
+                lemma + ']', tag + '()', '0.9', 'O', 'O', '0', 'ROOT']) + '\n'
+                for i, (lemma, tag) in enumerate(self.tag(text))]))
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        docs = json.loads(data.decode('utf-8'))['docs']
+        self.respond(''.join([''.join([lemma + '\t' + tag + '\n' for lemma, tag
+                in self.tag(' '.join(doc))]) + '\n' for doc in docs]))
+
+    def respond(self, data):
+        data = data.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FrogServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_frog_server(delay=0.0):
+    '''
+    Start stand-in Frog web service on a free local port.
+    '''
+    server = FrogServer(('localhost', 0), FrogHandler)
+    server.delay = delay
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def time_stage(stages, name, create):
+    '''
+    Time creation of a stage.
+    '''
+    start = time.time()
+    obj = create()
+    stages[name] = time.time() - start
+    return obj
+
+
+def benchmark_stages(input_dir, num_topics=10, seed=1, topic_params={},
+        workers=1):
+    '''
+    Time each stage of generating frames from pos-tagged documents.
+    '''
+    stages = {}
+    doc_reader = time_stage(stages, 'documents', lambda:
+            documents.DocumentReader(input_dir, pos_tag=False,
+            workers=workers))
+    topic_list = time_stage(stages, 'topics', lambda:
+            models.TopicList(doc_reader, num_topics, seed=seed,
+            **topic_params))
+    keyword_list = time_stage(stages, 'keywords', lambda:
+            keywords.KeywordList(doc_reader, topic_list=topic_list))
+    time_stage(stages, 'keywords tf-idf', lambda:
+            keywords.KeywordList(doc_reader,
+            tfidf_list=models.TfIdfList(doc_reader)))
+    for engine in FRAME_ENGINES:
+        time_stage(stages, 'frames ' + engine, lambda:
+                frames.FrameList(doc_reader, keyword_list, engine=engine,
+                workers=workers))
+    return stages
+
+
+def benchmark_text(input_dir, frog_url=None, workers=1):
+    '''
+    Time processing of plain text documents, tokenized with Segtok or
+    tagged by the Frog web service at frog_url.
+    '''
+    stages = {}
+    if frog_url:
+        frog_client = frogclient.FrogClient(frog_url)
+        time_stage(stages, 'documents', lambda:
+                documents.DocumentReader(input_dir, pos_tag=True,
+                workers=workers, frog_client=frog_client))
+    else:
+        time_stage(stages, 'documents', lambda:
+                documents.DocumentReader(input_dir, pos_tag=False,
+                workers=workers))
+    return stages
+
+
+def run_benchmarks(scales=SCALES, num_lemmas=20000, skew=1.2, num_topics=10,
+        seed=1, topic_config='chunked', workers=1, frog_delay=0.0):
+    '''
+    Time all stages on synthetic corpora of several sizes.
+
+    Pos-tagged documents go through all stages, plain text documents
+    through document processing with Segtok and with a stand-in Frog
+    service.
+    '''
+    topic_params = dict(TOPIC_CONFIGS)[topic_config]
+    frog_server = start_frog_server(frog_delay)
+    frog_url = 'http://localhost:' + str(frog_server.server_address[1]) + '/'
+
+    results = []
+    try:
+        for num_docs, doc_length in scales:
+            for path in ['tagged', 'text', 'frog']:
+                print('Benchmarking ' + path + ' documents, ' +
+                        str(num_docs) + ' x ' + str(doc_length) + ' ...')
+                dir_name = tempfile.mkdtemp()
+                try:
+                    input_dir = dir_name + os.sep + 'input'
+                    create_corpus(input_dir, num_docs, doc_length, num_lemmas,
+                            seed, skew, text=path != 'tagged')
+                    if path == 'tagged':
+                        stages = benchmark_stages(input_dir, num_topics, seed,
+                                topic_params, workers)
+                    else:
+                        stages = benchmark_text(input_dir, frog_url if path
+                                == 'frog' else None, workers)
+                finally:
+                    shutil.rmtree(dir_name)
+                results.append({'path': path, 'docs': num_docs,
+                        'doc_length': doc_length, 'stages': stages})
+    finally:
+        frog_server.shutdown()
+        frog_server.server_close()
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    '''
+    Print stage times next to baseline times, return number of stages
+    slower than the baseline by more than tolerance.
+    '''
+    baseline_stages = {}
+    for result in baseline['results']:
+        for stage, seconds in result['stages'].items():
+            baseline_stages[(result['path'], result['docs'],
+                    result['doc_length'], stage)] = seconds
+
+    print('Path\tScale\tStage\tBaseline\tSeconds\tRatio')
+    num_slower = 0
+    for result in results:
+        for stage, seconds in sorted(result['stages'].items()):
+            key = (result['path'], result['docs'], result['doc_length'],
+                    stage)
+            if key not in baseline_stages:
+                continue
+            ratio = seconds / max(baseline_stages[key], 0.001)
+            slower = ratio > 1 + tolerance
+            num_slower += slower
+            print(result['path'] + '\t' + str(result['docs']) + 'x' +
+                    str(result['doc_length']) + '\t' + stage + '\t' + '%.3f' %
+                    baseline_stages[key] + '\t' + '%.3f' % seconds + '\t' +
+                    '%.2f' % ratio + ('\tslower' if slower else ''))
+    return num_slower
+
+
+def benchmark_topics(doc_reader, num_topics=10, seed=1, configs=TOPIC_CONFIGS):
+    '''
+    Time LDA training configurations and compare their keywords.
+
+    Only single-worker configurations are checked for reproducibility,
+    multicore training isn't reproducible with a seed.
+    '''
+    results = []
+    for name, params in configs:
+        run_keywords = []
+        single = params.get('workers', 1) <= 1
+        for run in range(2 if single else 1):
+            start = time.time()
+            topic_list = models.TopicList(doc_reader, num_topics, seed=seed,
+                    **params)
+            seconds = time.time() - start
+            keyword_list = keywords.KeywordList(doc_reader,
+                    topic_list=topic_list)
+            run_keywords.append([k[0] for k in keyword_list.keywords])
+        results.append((name, seconds, run_keywords[0] == run_keywords[-1]
+                if single else None, run_keywords[0]))
+
+    print('Configuration\tSeconds\tReproducible\tKeywords in common')
+    for name, seconds, reproducible, kw in results:
+        common = len(set(kw) & set(results[0][3]))
+        print(name + '\t' + '%.2f' % seconds + '\t' + ('-' if
+                reproducible is None else str(reproducible)) +
+                '\t' + str(common) + '/' + str(len(results[0][3])))
+    return results
+
+
+def check_sweep(input_dir, grid=SWEEP_GRID, seed=1):
+    '''
+    Check that each configuration of a parameter sweep gives the same
+    keywords and frames as a separate run, with both keyword models.
+    Return number of configurations that differ.
+    '''
+    configs = generator.get_grid(grid)
+    results = []
+    for kmodel in ['lda', 'tf-idf']:
+        args = {'pos': False, 'kmodel': kmodel, 'tseed': seed,
+                'input_dir': input_dir, 'output_dir': None,
+                'cache_dir': None}
+        sweep = generator.generate_many(configs, **args)
+        for config, (keyword_list, frame_list) in zip(configs, sweep):
+            _, run_keywords, run_frames = generator.generate(**dict(args,
+                    **config))
+            results.append((kmodel, config, keyword_list.keywords ==
+                    run_keywords.keywords and frame_list.frames ==
+                    run_frames.frames))
+
+    print('Model\tConfiguration\tSame')
+    for kmodel, config, same in results:
+        print(kmodel + '\t' + ' '.join([k + '=' + str(v) for k, v in
+                sorted(config.items())]) + '\t' + str(same))
+    return sum(not same for kmodel, config, same in results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', required=False, type=str,
+            default=','.join([str(d) + 'x' + str(l) for d, l in SCALES]),
+            help='comma separated corpus sizes as docs x doc length')
+    parser.add_argument('--vocab', required=False, type=int, default=20000,
+            help='number of distinct lemmas')
+    parser.add_argument('--skew', required=False, type=float, default=1.2,
+            help='Zipf distribution parameter, greater than 1')
+    parser.add_argument('--tcount', required=False, type=int, default=10,
+            help='number of topics')
+    parser.add_argument('--tconfig', required=False, type=str,
+            default='chunked', help='LDA training configuration: ' +
+            ', '.join([c[0] for c in TOPIC_CONFIGS]))
+    parser.add_argument('--seed', required=False, type=int, default=1,
+            help='random seed')
+    parser.add_argument('--workers', required=False, type=int, default=1,
+            help='number of worker processes')
+    parser.add_argument('--frog-delay', required=False, type=float,
+            default=0.0, help='seconds stand-in Frog waits per request')
+    parser.add_argument('--output', required=False, type=str,
+            help='file to write results to as json')
+    parser.add_argument('--baseline', required=False, type=str,
+            help='json results file to compare with')
+    parser.add_argument('--tolerance', required=False, type=float,
+            default=0.2, help='allowed slowdown relative to baseline')
+    parser.add_argument('--topic-configs', required=False,
+            action='store_true', help='compare LDA training configurations ' +
+            'instead')
+    parser.add_argument('--docs', required=False, type=int, default=1000,
+            help='number of synthetic documents to compare LDA ' +
+            'configurations on')
+    parser.add_argument('--check-sweep', required=False,
+            action='store_true', help='check that a parameter sweep gives ' +
+            'the same results as separate runs instead')
+    args = parser.parse_args()
+
+    if args.topic_configs:
+        print('Benchmarking sample corpus ...')
+        doc_reader = documents.DocumentReader('input', pos_tag=False)
+        benchmark_topics(doc_reader, args.tcount, args.seed)
+
+        print('Benchmarking synthetic corpus ...')
+        input_dir = tempfile.mkdtemp()
+        try:
+            create_corpus(input_dir + os.sep + 'input', args.docs,
+                    num_lemmas=args.vocab, seed=args.seed, skew=args.skew)
+            doc_reader = documents.DocumentReader(input_dir + os.sep +
+                    'input')
+            benchmark_topics(doc_reader, args.tcount, args.seed)
+        finally:
+            shutil.rmtree(input_dir)
+        sys.exit()
+
+    if args.check_sweep:
+        print('Checking parameter sweep ...')
+        input_dir = tempfile.mkdtemp()
+        try:
+            create_corpus(input_dir + os.sep + 'input', args.docs,
+                    num_lemmas=args.vocab, seed=args.seed, skew=args.skew)
+            num_different = check_sweep(input_dir + os.sep + 'input',
+                    seed=args.seed)
+        finally:
+            shutil.rmtree(input_dir)
+        sys.exit(1 if num_different else 0)
+
+    scales = [tuple(int(n) for n in s.split('x')) for s in
+            args.scales.split(',')]
+    results = run_benchmarks(scales, args.vocab, args.skew, args.tcount,
+            args.seed, args.tconfig, args.workers, args.frog_delay)
+
+    print('Path\tScale\tStage\tSeconds')
+    for result in results:
+        for stage, seconds in sorted(result['stages'].items()):
+            print(result['path'] + '\t' + str(result['docs']) + 'x' +
+                    str(result['doc_length']) + '\t' + stage + '\t' +
+                    '%.3f' % seconds)
+
+    if args.output:
+        settings = dict(vars(args))
+        del settings['output'], settings['baseline']
+        with open(args.output, 'w') as f:
+            json.dump({'settings': settings, 'results': results}, f,
+                    indent=2, separators=(',', ': '), sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_results(results, baseline, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Frame Generator
+#
+# Copyright (C) 2016 Juliette Lonij, Koninklijke Bibliotheek -
+# National Library of the Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import cPickle as pickle
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+
+def hash_files(path):
+    '''
+    Get content hash of all files in a directory tree, or in a dict of
+    subdirectory names and dicts of in-memory files.
+    '''
+    sha1 = hashlib.sha1()
+    if isinstance(path, dict):
+        for dir_name in sorted(path):
+            for filename in sorted(path[dir_name]):
+                data = path[dir_name][filename]
+                if hasattr(data, 'read'):
+                    data.seek(0)
+                    data = data.read()
+                sha1.update(os.path.join(dir_name, filename) + '\0')
+                sha1.update(data)
+                sha1.update('\0')
+        return sha1.hexdigest()
+    for dir_name, dir_names, filenames in sorted(os.walk(path)):
+        dir_names.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(dir_name, filename)
+            sha1.update(os.path.relpath(file_path, path) + '\0')
+            with open(file_path, 'rb') as f:
+                for data in iter(lambda: f.read(2 ** 20), ''):
+                    sha1.update(data)
+            sha1.update('\0')
+    return sha1.hexdigest()
+
+
+class FrogCache(object):
+    '''
+    Persistent cache of Frog annotations in an SQLite database.
+    '''
+
+    def __init__(self, path, namespace='', max_bytes=2 ** 30):
+        '''
+        Open cache and invalidate it if the namespace has changed.
+        '''
+        self.path = path
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.size = None
+
+        self.connection = None
+        self.pid = None
+
+        db = self.get_connection()
+        db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, ' +
+                'value TEXT)')
+        db.execute('CREATE TABLE IF NOT EXISTS annotations (hash TEXT ' +
+                'PRIMARY KEY, tokens BLOB, size INTEGER, atime REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS annotations_atime ON ' +
+                'annotations (atime)')
+
+        # Cached annotations are only valid for the same Frog service
+        row = db.execute('SELECT value FROM meta WHERE key = ?',
+                ('namespace',)).fetchone()
+        if not row or row[0] != namespace:
+            self.clear()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['connection'] = None
+        state['pid'] = None
+        return state
+
+    def get_connection(self):
+        '''
+        Get database connection of the current process.
+        '''
+        if self.pid != os.getpid():
+            dir_name = os.path.dirname(self.path)
+            if dir_name and not os.path.isdir(dir_name):
+                os.makedirs(dir_name)
+            self.connection = sqlite3.connect(self.path, timeout=60,
+                    isolation_level=None)
+            self.pid = os.getpid()
+        return self.connection
+
+    def get_key(self, sentences):
+        '''
+        Get content hash of a batch of sentences.
+        '''
+        return hashlib.sha1('\n'.join(sentences).encode('utf-8')).hexdigest()
+
+    def get(self, sentences):
+        '''
+        Get cached tokens for a batch of sentences, None if not cached.
+        '''
+        db = self.get_connection()
+        key = self.get_key(sentences)
+        row = db.execute('SELECT tokens FROM annotations WHERE hash = ?',
+                (key,)).fetchone()
+        if not row:
+            self.misses += 1
+            return None
+        self.hits += 1
+        db.execute('UPDATE annotations SET atime = ? WHERE hash = ?',
+                (time.time(), key))
+        return [tuple(t) for t in json.loads(zlib.decompress(row[0]))]
+
+    def put(self, sentences, tokens):
+        '''
+        Cache tokens for a batch of sentences.
+        '''
+        db = self.get_connection()
+        data = zlib.compress(json.dumps(tokens))
+        db.execute('INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)',
+                (self.get_key(sentences), sqlite3.Binary(data), len(data),
+                time.time()))
+        if self.size is not None:
+            self.size += len(data)
+        if self.size is None or self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        '''
+        Remove least recently used annotations while over the size limit.
+        '''
+        db = self.get_connection()
+        size = db.execute('SELECT SUM(size) FROM annotations').fetchone()[0]
+        size = size or 0
+        while size > self.max_bytes:
+            rows = db.execute('SELECT hash, size FROM annotations ORDER BY ' +
+                    'atime LIMIT 100').fetchall()
+            for key, row_size in rows:
+                db.execute('DELETE FROM annotations WHERE hash = ?', (key,))
+                size -= row_size
+                if size <= self.max_bytes:
+                    break
+        self.size = size
+
+    def clear(self):
+        '''
+        Remove all annotations and set the namespace.
+        '''
+        db = self.get_connection()
+        db.execute('DELETE FROM annotations')
+        db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('namespace',
+                self.namespace))
+
+
+class StageCache(object):
+    '''
+    Content-addressed cache of pickled processing stages.
+    '''
+
+    def __init__(self, path, max_bytes=2 ** 32):
+        '''
+        Set StageCache attributes.
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get_key(self, *args):
+        '''
+        Get hash of stage input and parameters.
+        '''
+        return hashlib.sha1(json.dumps(args, sort_keys=True)).hexdigest()
+
+    def get_path(self, stage, key):
+        '''
+        Get path of cached stage.
+        '''
+        return self.path + os.sep + stage + '-' + key + '.pickle'
+
+    def get(self, stage, key):
+        '''
+        Get cached stage, None if not cached.
+        '''
+        path = self.get_path(stage, key)
+        try:
+            with open(path, 'rb') as f:
+                obj = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(path, None)
+        return obj
+
+    def put(self, stage, key, obj):
+        '''
+        Cache stage.
+        '''
+        # Write to temporary file first, so no partial files are read
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.get_path(stage, key))
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove least recently used stages while over the size limit.
+        '''
+        files = []
+        for filename in os.listdir(self.path):
+            if filename.endswith('.pickle'):
+                stat = os.stat(self.path + os.sep + filename)
+                files.append((stat.st_mtime, stat.st_size, filename))
+        size = sum(f[1] for f in files)
+        for mtime, file_size, filename in sorted(files):
+            if size <= self.max_bytes:
+                break
+            os.remove(self.path + os.sep + filename)
+            size -= file_size
+
+
+class ResultCache(object):
+    '''
+    In-memory cache of result strings, limited by their total size.
+    '''
+
+    def __init__(self, max_bytes=2 ** 26):
+        '''
+        Set ResultCache attributes.
+        '''
+        self.max_bytes = max_bytes
+        self.results = collections.OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Get cached result, None if not cached.
+        '''
+        with self.lock:
+            if key not in self.results:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Move to the end, the most recently used
+            result = self.results.pop(key)
+            self.results[key] = result
+            return result
+
+    def put(self, key, result):
+        '''
+        Cache result, removing least recently used results while over the
+        size limit.
+        '''
+        with self.lock:
+            if key in self.results:
+                self.size -= len(self.results.pop(key))
+            if len(result) > self.max_bytes:
+                return
+            self.results[key] = result
+            self.size += len(result)
+            while self.size > self.max_bytes:
+                key, old_result = self.results.popitem(last=False)
+                self.size -= len(old_result)
+                self.evictions += 1
+
+    def get_stats(self):
+        '''
+        Get hit, miss and eviction counts and cache size.
+        '''
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'results': len(self.results),
+                    'bytes': self.size, 'max_bytes': self.max_bytes}
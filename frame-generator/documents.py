@@ -19,20 +19,398 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import frogclient
 import gensim
+import hashlib
 import io
+import itertools
 import json
+import mmap
+import multiprocessing
+import normalizer
+import numpy
 import os
-import re
+import shutil
 import sys
-import time
-import urllib
 
 from lxml import etree
+from metrics import Metrics
 from segtok import segmenter
 from segtok import tokenizer
 
-FROG_URL = 'http://www.kbresearch.nl/frogger/?'
+FROG_URL = 'http://www.kbresearch.nl/frogger/'
+
+# Change to invalidate cached Frog annotations, e.g. after a Frog upgrade
+FROG_VERSION = ''
+
+# DocumentReader and document source shared with worker processes in
+# parallel mode
+_doc_reader = None
+_doc_source = None
+
+# Token ids combine a lemma id and a tag id: lemma_id << TAG_BITS | tag_id
+TAG_BITS = 8
+TAG_MASK = (1 << TAG_BITS) - 1
+
+
+def _process_file(args):
+    '''
+    Process a text or xml file in a worker process.
+    '''
+    filename, doc_length = args
+    _doc_reader.reset_stats()
+    docs = _doc_reader.process_file(_doc_source, filename, doc_length)
+    return docs, _doc_reader.get_stats()
+
+
+def get_source(input_dir, name):
+    '''
+    Get input subdirectory, or its files if input is given as a dict.
+
+    In-memory input is a dict of subdirectory names (docs, stop, regex) and
+    dicts of filenames and file contents (strings or file-like objects).
+    '''
+    if isinstance(input_dir, dict):
+        return input_dir.get(name, {})
+    return input_dir + os.sep + name
+
+
+def list_files(source, extensions):
+    '''
+    List names of files with given extensions in directory or dict.
+    '''
+    filenames = source.keys() if isinstance(source, dict) else \
+            os.listdir(source)
+    return [f for f in filenames if os.path.splitext(f)[1] in extensions]
+
+
+def map_file(source, filename):
+    '''
+    Memory-map a file read-only, or get contents of an in-memory file.
+    '''
+    if isinstance(source, dict):
+        return read_file(source, filename)
+    with open(os.path.join(source, filename), 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_file(source, filename):
+    '''
+    Read contents of file in directory or dict.
+    '''
+    if isinstance(source, dict):
+        data = source[filename]
+        if hasattr(data, 'read'):
+            data.seek(0)
+            data = data.read()
+        return data
+    with open(source + os.sep + filename) as f:
+        return f.read()
+
+
+def get_file_key(source, filename):
+    '''
+    Get key identifying the version of a file: size and modification time of
+    a file in a directory, content hash of a file in a dict.
+    '''
+    if isinstance(source, dict):
+        return hashlib.sha1(read_file(source, filename)).hexdigest()
+    stat = os.stat(source + os.sep + filename)
+    return (stat.st_size, stat.st_mtime)
+
+
+class TokenStore(object):
+    '''
+    Compact store of documents as arrays of lemma and tag ids.
+    '''
+
+    def __init__(self):
+        '''
+        Create lemma and tag tables and document list.
+        '''
+        self.lemmas = []
+        self.lemma_ids = {}
+        self.tags = []
+        self.tag_ids = {}
+        self.docs = []
+        self.tokens = {}
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    def __getitem__(self, i):
+        return self.docs[i]
+
+    def add(self, tokens):
+        '''
+        Add document given as list of (lemma, tag) pairs.
+        '''
+        self.add_arrays(*self.encode(tokens))
+
+    def add_arrays(self, lemma_ids, tag_ids):
+        '''
+        Add document given as lemma and tag id arrays.
+        '''
+        # Copy NumPy arrays, which may be views of memory-mapped files
+        if not isinstance(lemma_ids, array.array):
+            lemma_array = array.array('i')
+            lemma_array.fromstring(lemma_ids)
+            tag_array = array.array('B')
+            tag_array.fromstring(tag_ids)
+            lemma_ids, tag_ids = lemma_array, tag_array
+        self.docs.append((lemma_ids, tag_ids))
+
+    def close(self):
+        '''
+        Finish adding documents.
+        '''
+        pass
+
+    def reopen(self):
+        '''
+        Continue adding documents.
+        '''
+        pass
+
+    def encode(self, tokens):
+        '''
+        Encode list of (lemma, tag) pairs as lemma and tag id arrays.
+        '''
+        lemma_ids = array.array('i')
+        tag_ids = array.array('B')
+        for lemma, tag in tokens:
+            if lemma not in self.lemma_ids:
+                self.lemma_ids[lemma] = len(self.lemmas)
+                self.lemmas.append(lemma)
+            if tag not in self.tag_ids:
+                assert len(self.tags) <= TAG_MASK, 'Too many tags'
+                self.tag_ids[tag] = len(self.tags)
+                self.tags.append(tag)
+            lemma_ids.append(self.lemma_ids[lemma])
+            tag_ids.append(self.tag_ids[tag])
+        return lemma_ids, tag_ids
+
+    def map_vocabulary(self, lemmas, tags):
+        '''
+        Add lemmas and tags to tables, return arrays mapping their positions
+        to lemma and tag ids.
+        '''
+        for lemma in lemmas:
+            if lemma not in self.lemma_ids:
+                self.lemma_ids[lemma] = len(self.lemmas)
+                self.lemmas.append(lemma)
+        for tag in tags:
+            if tag not in self.tag_ids:
+                assert len(self.tags) <= TAG_MASK, 'Too many tags'
+                self.tag_ids[tag] = len(self.tags)
+                self.tags.append(tag)
+        return (numpy.array([self.lemma_ids[l] for l in lemmas],
+                dtype=numpy.int32), numpy.array([self.tag_ids[t] for t in
+                tags], dtype=numpy.uint8))
+
+    def save(self, path):
+        '''
+        Save documents in binary format: lemma and tag id arrays, document
+        offsets and vocabulary, in files with path as prefix.
+        '''
+        offsets = array.array('l', [0])
+        with open(path + '.lemmas', 'wb') as lemma_file:
+            with open(path + '.tags', 'wb') as tag_file:
+                for lemma_ids, tag_ids in self:
+                    lemma_ids.tofile(lemma_file)
+                    tag_ids.tofile(tag_file)
+                    offsets.append(offsets[-1] + len(lemma_ids))
+        self.save_vocabulary(path, offsets)
+
+    def save_vocabulary(self, path, offsets):
+        '''
+        Save document offsets and vocabulary of binary format.
+        '''
+        with open(path + '.offsets', 'wb') as f:
+            offsets.tofile(f)
+
+        # Vocabulary is written last, it marks the documents as complete
+        vocab = {'byteorder': sys.byteorder,
+                'lemma_size': array.array('i').itemsize,
+                'offset_size': offsets.itemsize, 'lemmas': self.lemmas,
+                'tags': self.tags}
+        with io.open(path + '.vocab', 'w', encoding='utf-8') as f:
+            f.write(unicode(json.dumps(vocab, ensure_ascii=False)))
+
+    def get_lengths(self):
+        '''
+        Get number of tokens of each document.
+        '''
+        return [len(lemma_ids) for lemma_ids, tag_ids in self.docs]
+
+    def get_token(self, token_id):
+        '''
+        Get token string for token id.
+        '''
+        if token_id not in self.tokens:
+            lemma = self.lemmas[token_id >> TAG_BITS]
+            tag = self.tags[token_id & TAG_MASK]
+            self.tokens[token_id] = lemma + '/' + tag if tag else lemma
+        return self.tokens[token_id]
+
+    def get_token_id(self, token):
+        '''
+        Get token id for token string, None if not in store.
+        '''
+        lemma, _, tag = token.partition('/')
+        if lemma not in self.lemma_ids or tag not in self.tag_ids:
+            return None
+        return self.lemma_ids[lemma] << TAG_BITS | self.tag_ids[tag]
+
+    def get_tokens(self, doc):
+        '''
+        Get document arrays as list of token strings.
+        '''
+        lemma_ids, tag_ids = doc
+        return [self.get_token(l << TAG_BITS | t) for l, t in
+                itertools.izip(lemma_ids, tag_ids)]
+
+
+class DiskTokenStore(TokenStore):
+    '''
+    Token store keeping document arrays on disk instead of in memory.
+    '''
+
+    def __init__(self, path):
+        '''
+        Create lemma and tag tables and document files.
+        '''
+        super(DiskTokenStore, self).__init__()
+        self.lemma_path = path + os.sep + 'docs.lemmas'
+        self.tag_path = path + os.sep + 'docs.tags'
+        self.offsets = array.array('l', [0])
+        self.lemma_file = open(self.lemma_path, 'wb')
+        self.tag_file = open(self.tag_path, 'wb')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['lemma_file'] = None
+        state['tag_file'] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return self.iter_docs(0, len(self))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.iter_docs(*i.indices(len(self))[:2])
+        return next(self.iter_docs(i, i + 1))
+
+    def add_arrays(self, lemma_ids, tag_ids):
+        '''
+        Append document given as lemma and tag id arrays to files.
+        '''
+        lemma_ids.tofile(self.lemma_file)
+        tag_ids.tofile(self.tag_file)
+        self.offsets.append(self.offsets[-1] + len(lemma_ids))
+
+    def close(self):
+        '''
+        Finish adding documents.
+        '''
+        self.lemma_file.close()
+        self.tag_file.close()
+
+    def reopen(self):
+        '''
+        Continue adding documents to the end of the files.
+        '''
+        # Remove data of documents added after the offsets were saved
+        self.lemma_file = open(self.lemma_path, 'r+b')
+        self.lemma_file.truncate(self.offsets[-1] *
+                array.array('i').itemsize)
+        self.lemma_file.seek(0, os.SEEK_END)
+        self.tag_file = open(self.tag_path, 'r+b')
+        self.tag_file.truncate(self.offsets[-1])
+        self.tag_file.seek(0, os.SEEK_END)
+
+    def save(self, path):
+        '''
+        Save documents in binary format, copying the document files.
+        '''
+        shutil.copyfile(self.lemma_path, path + '.lemmas')
+        shutil.copyfile(self.tag_path, path + '.tags')
+        self.save_vocabulary(path, self.offsets)
+
+    def get_lengths(self):
+        '''
+        Get number of tokens of each document.
+        '''
+        return [self.offsets[i + 1] - self.offsets[i] for i in
+                range(len(self))]
+
+    def iter_docs(self, start, end):
+        '''
+        Read documents in range from files.
+        '''
+        lemma_size = array.array('i').itemsize
+        with open(self.lemma_path, 'rb') as lemma_file:
+            with open(self.tag_path, 'rb') as tag_file:
+                lemma_file.seek(self.offsets[start] * lemma_size)
+                tag_file.seek(self.offsets[start])
+                for i in xrange(start, end):
+                    length = self.offsets[i + 1] - self.offsets[i]
+                    lemma_ids = array.array('i')
+                    lemma_ids.fromfile(lemma_file, length)
+                    tag_ids = array.array('B')
+                    tag_ids.fromfile(tag_file, length)
+                    yield lemma_ids, tag_ids
+
+
+def iter_binary_docs(source, filename, store):
+    '''
+    Generate lemma and tag id arrays of documents saved in binary format,
+    see TokenStore.save, with the ids of the given token store.
+
+    The arrays are NumPy arrays, views of the memory-mapped files if the ids
+    are the same, which are closed when the generator finishes.
+    '''
+    name = filename[:-len('.vocab')]
+    vocab = json.loads(read_file(source, filename).decode('utf-8'))
+    assert (vocab['byteorder'], vocab['lemma_size'],
+            vocab['offset_size']) == (sys.byteorder,
+            array.array('i').itemsize, array.array('l').itemsize), \
+            'Binary documents saved on an incompatible platform: ' + filename
+    lemma_map, tag_map = store.map_vocabulary(vocab['lemmas'], vocab['tags'])
+
+    # Ids are only mapped if the store numbers the vocabulary differently
+    if numpy.array_equal(lemma_map, numpy.arange(len(lemma_map))):
+        lemma_map = None
+    if numpy.array_equal(tag_map, numpy.arange(len(tag_map))):
+        tag_map = None
+
+    files = [map_file(source, name + ext) for ext in ['.offsets', '.lemmas',
+            '.tags']]
+    try:
+        offsets = numpy.frombuffer(files[0],
+                dtype=numpy.dtype('i' + str(vocab['offset_size'])))
+        lemma_ids = numpy.frombuffer(files[1], dtype=numpy.int32)
+        tag_ids = numpy.frombuffer(files[2], dtype=numpy.uint8)
+        for i in xrange(len(offsets) - 1):
+            start, end = offsets[i], offsets[i + 1]
+            doc_lemma_ids = lemma_ids[start:end]
+            doc_tag_ids = tag_ids[start:end]
+            yield (doc_lemma_ids if lemma_map is None else
+                    lemma_map[doc_lemma_ids], doc_tag_ids if tag_map is None
+                    else tag_map[doc_tag_ids])
+    finally:
+        for f in files:
+            if isinstance(f, mmap.mmap):
+                f.close()
 
 
 class DocumentReader(object):
@@ -40,25 +418,48 @@ class DocumentReader(object):
     Process input documents.
     '''
 
-    def __init__(self, input_dir, doc_length=0, pos_tag=True):
+    def __init__(self, input_dir, doc_length=0, pos_tag=True,
+            stream_dir=None, workers=1, frog_client=None, frog_cache=None,
+            metrics=None):
         '''
         Create regex list, stop word list, document list, dictionary and corpus.
         '''
-        self.regex_dir = input_dir + os.sep + 'regex'
-        self.doc_dir = input_dir + os.sep + 'docs'
-        self.stop_dir = input_dir + os.sep + 'stop'
+        self.regex_dir = get_source(input_dir, 'regex')
+        self.doc_dir = get_source(input_dir, 'docs')
+        self.stop_dir = get_source(input_dir, 'stop')
 
         self.doc_length = doc_length
         self.pos_tag = pos_tag
+        self.stream_dir = stream_dir
+        self.workers = workers
+        self.frog_client = frog_client or frogclient.FrogClient(FROG_URL)
+        self.frog_cache = frog_cache
+        self.metrics = metrics or Metrics()
 
         self.log = []
-
-        self.regex_list = self.get_regex(self.regex_dir)
-        self.stop_list = self.get_stop_words(self.stop_dir)
-        self.doc_list = self.get_documents(self.doc_dir, doc_length)
-
-        self.dictionary = self.get_dictionary(self.doc_list, self.stop_list)
-        self.corpus = self.get_corpus()
+        self.index = None
+        self.filenames = []
+        self.file_keys = {}
+
+        with self.metrics.stage('documents'):
+            self.regex_list = self.get_regex(self.regex_dir)
+            self.normalizer = normalizer.Normalizer(self.regex_list)
+            self.stop_list = self.get_stop_words(self.stop_dir)
+            self.doc_store = self.get_documents(self.doc_dir, doc_length)
+
+        with self.metrics.stage('dictionary'):
+            self.dictionary = self.get_dictionary()
+        with self.metrics.stage('corpus'):
+            self.corpus = self.get_corpus()
+
+    def __getstate__(self):
+        # Index is created again when needed, in-memory input isn't kept
+        state = self.__dict__.copy()
+        state['index'] = None
+        for attr in ['regex_dir', 'doc_dir', 'stop_dir']:
+            if isinstance(state[attr], dict):
+                state[attr] = {}
+        return state
 
     def get_regex(self, path):
         '''
@@ -66,17 +467,15 @@ class DocumentReader(object):
         '''
         print('Processing regular expressions ...')
         regex_list = []
-        for filename in [f for f in os.listdir(path) if f[-4:] in ['.txt',
-                '.tsv', '.csv']]:
-            with open(path + '/' + filename) as f:
-                print('Processing file: ' + filename)
-                doc = self.decode(f.read())
-                lines = [l for l in doc.splitlines() if l]
-                regex = [l.split('\t') for l in lines if
-                        len(l.split('\t')) == 2]
-                regex = [[r[0].strip(), r[1].strip()] for r in regex if
-                        r[0].strip() and r[1].strip()]
-                regex_list += regex
+        for filename in list_files(path, ['.txt', '.tsv', '.csv']):
+            print('Processing file: ' + filename)
+            doc = self.decode(read_file(path, filename))
+            lines = [l for l in doc.splitlines() if l]
+            regex = [l.split('\t') for l in lines if
+                    len(l.split('\t')) == 2]
+            regex = [[r[0].strip(), r[1].strip()] for r in regex if
+                    r[0].strip() and r[1].strip()]
+            regex_list += regex
         print('Number of regular expressions: ' + str(len(regex_list)))
         return regex_list
 
@@ -86,127 +485,240 @@ class DocumentReader(object):
         '''
         print('Processing stop words ...')
         stop_list = []
-        for filename in [f for f in os.listdir(path) if f.endswith('.txt')]:
+        for filename in list_files(path, ['.txt']):
             print('Processing file: ' + filename)
-            with open(path + os.sep + filename) as f:
-                s = self.decode(f.read())
-                stop_list += [sw.lower() for sw in s.split() if sw]
+            s = self.decode(read_file(path, filename))
+            stop_list += [sw.lower() for sw in s.split() if sw]
         print('Number of stop words: ' + str(len(stop_list)))
         return stop_list
 
     def get_documents(self, path, doc_length):
         '''
-        Create document list from input documents.
+        Create document store from input documents.
         '''
         print('Processing documents ...')
-        docs = []
-        for filename in [f for f in os.listdir(path) if f[-4:] in ['.txt',
-                '.xml']]:
-            with open(path + '/' + filename) as f:
-                print('Processing file: ' + filename)
-
-                # Remove xml tags and decode
-                if filename.endswith('.xml'):
-                    xml = etree.fromstring(f.read())
-                    text = etree.tostring(xml, encoding='utf-8', method='text')
-                    doc = text.decode('utf-8')
-                else:
-                    doc = self.decode(f.read())
-
-                # Process user provided regular expressions
-                for regex in self.regex_list:
-                    doc = re.sub(regex[0], regex[1], doc, flags=re.I)
-
-                # Remove unwanted characters and whitespace
-                unwanted_chars = ['&', '/', '|', '_', ':', '=', '(',
-                            ')', '[', ']']
-                for char in unwanted_chars:
-                    doc = doc.replace(char, '')
-                doc = ' '.join(doc.split())
-
-                # Sentence chunk with Segtok
-                sentences = [s for s in segmenter.split_single(doc)]
-
-                # Split large documents into smaller parts
-                if doc_length > 0:
-                    sub_docs = [sentences[i:i + doc_length] for i in
-                            xrange(0, len(sentences), doc_length)]
-                else:
-                    sub_docs = [sentences]
-
-                # Tokenize with Segtok or Frog
-                for sub_doc in sub_docs:
-                    tokens = []
-                    if self.pos_tag:
-                        tokens += self.frogger(sub_doc, filename)
-                    else:
-                        for sentence in sub_doc:
-                            tokens += [t.lower() for t in
-                                    tokenizer.word_tokenizer(sentence)]
-                    if len(tokens):
-                        docs.append(tokens)
-
-        for filename in [f for f in os.listdir(path) if f.endswith('.json')]:
-            with open(path + '/' + filename) as f:
-                print('Processing file: ' + filename)
-                docs += json.load(f)['docs']
+        if self.stream_dir:
+            docs = DiskTokenStore(self.stream_dir)
+        else:
+            docs = TokenStore()
+        self.add_documents(docs, path, doc_length)
+        docs.close()
 
         print('Number of (sub)documents: ' + str(len(docs)))
-        assert docs, 'No documents found'
+        if self.frog_cache:
+            print('Frog cache hits: ' + str(self.frog_cache.hits) +
+                    ', misses: ' + str(self.frog_cache.misses))
+        assert len(docs), 'No documents found'
 
         return docs
 
-    def frogger(self, to_frog, filename):
-        '''
-        Process document with Frog web service.
-        '''
-        tokens = []
-        while len(to_frog):
-            batch_size = min(10, len(to_frog))
-            batch = ' '.join(to_frog[:batch_size])
-            query_string = urllib.urlencode({'text': batch.encode('utf-8')})
-
-            i = 0
-            data = None
-            while not data:
-                try:
-                    data = urllib.urlopen(FROG_URL + query_string)
-                    data = data.read().decode('utf-8')
-                except IOError:
-                    if i < 2:
-                        print('Frog data not found, retrying ...')
-                        time.sleep(10)
-                        i += 1
-                    else:
-                        print('Frog data not found, skipping document!')
-                        self.log.append('Frog data not found for (part of): ' +
-                                filename)
-                        return []
-
-            new_tokens = [line.split('\t') for line in data.split('\n')
-                    if len(line)]
+    def add_documents(self, docs, path, doc_length):
+        '''
+        Add input documents not processed before to document store.
+        '''
+        for tokens in self.iter_documents(path, doc_length):
+            docs.add(tokens)
+            self.metrics.count('documents')
+            self.metrics.count('tokens', len(tokens))
+
+        # Documents in binary format are added as arrays, without decoding
+        processed = set(self.filenames)
+        vocab_filenames = sorted([f for f in list_files(path, ['.vocab']) if
+                f not in processed])
+        self.add_filenames(path, vocab_filenames)
+        for filename in vocab_filenames:
+            print('Processing file: ' + filename)
+            for lemma_ids, tag_ids in iter_binary_docs(path, filename, docs):
+                docs.add_arrays(lemma_ids, tag_ids)
+                self.metrics.count('documents')
+                self.metrics.count('tokens', len(lemma_ids))
+
+    def add_filenames(self, path, filenames):
+        '''
+        Mark input files as processed, with the key of their current version.
+        '''
+        self.filenames += filenames
+        for filename in filenames:
+            self.file_keys[filename] = get_file_key(path, filename)
+
+    def get_changed_files(self, input_dir):
+        '''
+        Get names of processed input files that were changed since.
+        '''
+        path = get_source(input_dir, 'docs')
+        filenames = set(list_files(path, ['.txt', '.xml', '.json', '.vocab']))
+        return sorted([f for f, key in self.file_keys.items() if f in
+                filenames and get_file_key(path, f) != key])
+
+    def iter_documents(self, path, doc_length):
+        '''
+        Generate tokenized (sub)documents from input documents not processed
+        before.
+        '''
+        processed = set(self.filenames)
+        filenames = sorted([f for f in list_files(path, ['.txt', '.xml']) if
+                f not in processed])
+        json_filenames = sorted([f for f in list_files(path, ['.json']) if
+                f not in processed])
+        self.add_filenames(path, filenames + json_filenames)
+
+        if self.workers > 1 and len(filenames) > 1:
+            for tokens in self.iter_parallel(path, filenames, doc_length):
+                yield tokens
+        else:
             try:
-                assert len(new_tokens[0]) == 10, 'Frog data invalid'
-                tokens += [t[2].lower() + '/' + t[4].split('(')[0] for t in
-                        new_tokens if len(t) == 10]
-            except AssertionError:
-                print('Frog data invalid, skipping document!')
-                self.log.append('Frog data invalid for (part of): ' + filename)
-                return []
+                for filename in filenames:
+                    for tokens in self.process_file(path, filename,
+                            doc_length):
+                        yield tokens
+            finally:
+                self.frog_client.close()
+
+        for filename in json_filenames:
+            print('Processing file: ' + filename)
+            for doc in json.loads(read_file(path, filename))['docs']:
+                yield [t.split('/')[:2] if '/' in t else (t, '') for t in
+                        doc]
+
+    def iter_parallel(self, path, filenames, doc_length):
+        '''
+        Generate tokenized (sub)documents from files processed in parallel.
+        '''
+        global _doc_reader, _doc_source
+
+        # Workers inherit this DocumentReader and source when forked
+        _doc_reader = self
+        _doc_source = path
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            results = pool.imap(_process_file, [(filename, doc_length) for
+                    filename in filenames])
+
+            # Collect documents, log lines and statistics in file order
+            for docs, stats in results:
+                self.add_stats(stats)
+                for tokens in docs:
+                    yield tokens
+        finally:
+            pool.close()
+            pool.join()
+            _doc_reader = None
+            _doc_source = None
+
+    def process_file(self, path, filename, doc_length):
+        '''
+        Create tokenized (sub)documents from a text or xml file.
+        '''
+        docs = []
+        print('Processing file: ' + filename)
+
+        # Remove xml tags and decode
+        if filename.endswith('.xml'):
+            xml = etree.fromstring(read_file(path, filename))
+            text = etree.tostring(xml, encoding='utf-8', method='text')
+            doc = text.decode('utf-8')
+        else:
+            doc = self.decode(read_file(path, filename))
+
+        # Process user provided regular expressions, remove unwanted
+        # characters and whitespace
+        doc = self.normalizer.normalize(doc)
+
+        # Sentence chunk with Segtok
+        sentences = [s for s in segmenter.split_single(doc)]
+
+        # Split large documents into smaller parts
+        if doc_length > 0:
+            sub_docs = [sentences[i:i + doc_length] for i in
+                    xrange(0, len(sentences), doc_length)]
+        else:
+            sub_docs = [sentences]
+
+        # Tokenize with Segtok or Frog
+        if self.pos_tag:
+            sub_docs = self.frogger(sub_docs, filename)
+        else:
+            sub_docs = [[(t.lower(), '') for sentence in sub_doc for t in
+                    tokenizer.word_tokenizer(sentence)] for sub_doc in
+                    sub_docs]
+        for tokens in sub_docs:
+            if len(tokens):
+                docs.append(tokens)
+            else:
+                self.metrics.count('skipped_documents')
 
-            to_frog = to_frog[batch_size:]
+        return docs
 
-        return tokens
+    def frogger(self, sub_docs, filename):
+        '''
+        Process (sub)documents with Frog web service.
+        '''
+        # Look up cached annotations first
+        docs = [None] * len(sub_docs)
+        if self.frog_cache:
+            docs = [self.frog_cache.get(sub_doc) for sub_doc in sub_docs]
+
+        to_frog = [i for i, tokens in enumerate(docs) if tokens is None]
+        num_requests = self.frog_client.num_requests
+        num_retries = self.frog_client.num_retries
+        with self.metrics.stage('frog'):
+            results = self.frog_client.tag_docs([sub_docs[i] for i in
+                    to_frog])
+        self.metrics.count('frog_requests', self.frog_client.num_requests -
+                num_requests)
+        self.metrics.count('frog_retries', self.frog_client.num_retries -
+                num_retries)
+        for i, (tokens, error) in zip(to_frog, results):
+            if error:
+                self.log.append('Frog data ' + error + ' for (part of): ' +
+                        filename)
+            elif self.frog_cache:
+                self.frog_cache.put(sub_docs[i], tokens)
+            docs[i] = tokens
+        return docs
 
-    def get_dictionary(self, doc_list, stop_list):
+    def reset_stats(self):
+        '''
+        Reset log and processing statistics.
+        '''
+        self.log = []
+        self.normalizer.reset_stats()
+        self.metrics.reset_counters()
+        if self.frog_cache:
+            self.frog_cache.hits = 0
+            self.frog_cache.misses = 0
+
+    def get_stats(self):
+        '''
+        Get log and processing statistics.
+        '''
+        stats = {'log': self.log, 'regex_hits': self.normalizer.hits,
+                'regex_times': self.normalizer.times,
+                'counters': self.metrics.counters}
+        if self.frog_cache:
+            stats['frog_cache_hits'] = self.frog_cache.hits
+            stats['frog_cache_misses'] = self.frog_cache.misses
+        return stats
+
+    def add_stats(self, stats):
+        '''
+        Add log and processing statistics, e.g. from a worker process.
+        '''
+        self.log += stats['log']
+        self.normalizer.add_stats(stats['regex_hits'], stats['regex_times'])
+        self.metrics.add_counters(stats['counters'])
+        if self.frog_cache:
+            self.frog_cache.hits += stats['frog_cache_hits']
+            self.frog_cache.misses += stats['frog_cache_misses']
+
+    def get_dictionary(self):
         '''
         Create dictionary from document and stop word lists.
         '''
         print('Generating dictionary ...')
-        dictionary = gensim.corpora.Dictionary(self.iter_docs(doc_list,
-                stop_list))
-        no_below = 1 if len(self.doc_list) <= 10 else 2
-        no_above = 1 if len(self.doc_list) <= 10 else 0.95
+        dictionary = gensim.corpora.Dictionary(self.iter_docs())
+        no_below = 1 if len(self.doc_store) <= 10 else 2
+        no_above = 1 if len(self.doc_store) <= 10 else 0.95
         dictionary.filter_extremes(no_below=no_below, no_above=no_above,
                 keep_n=100000)
         num_tokens = len(dictionary.items())
@@ -218,22 +730,106 @@ class DocumentReader(object):
         Create corpus.
         '''
         print('Generating corpus ...')
-        corpus = [self.dictionary.doc2bow(text) for text in
-                self.iter_docs(self.doc_list, self.stop_list)]
-        return corpus
+        corpus = (self.dictionary.doc2bow(text) for text in self.iter_docs())
+        if self.stream_dir:
+            path = self.stream_dir + os.sep + 'corpus.mm'
+            gensim.corpora.MmCorpus.serialize(path, corpus)
+            return gensim.corpora.MmCorpus(path)
+        return list(corpus)
+
+    def update(self, input_dir):
+        '''
+        Add new input documents to document store, dictionary and corpus.
 
-    def iter_docs(self, doc_list, stop_list):
+        The dictionary is extended without filtering rare and common tokens,
+        so results differ from those of a full rebuild. Return corpus of the
+        new documents.
         '''
-        Generate tokens from document and stop word lists.
+        print('Processing new documents ...')
+        start = len(self.doc_store)
+        with self.metrics.stage('documents'):
+            self.doc_store.reopen()
+            self.add_documents(self.doc_store, get_source(input_dir, 'docs'),
+                    self.doc_length)
+            self.doc_store.close()
+        self.index = None
+        print('Number of new (sub)documents: ' + str(len(self.doc_store) -
+                start))
+        if len(self.doc_store) == start:
+            return []
+
+        # Extend dictionary, ids of existing tokens stay the same
+        print('Updating dictionary ...')
+        with self.metrics.stage('dictionary'):
+            new_docs = [list(tokens) for tokens in self.iter_docs(start)]
+            self.dictionary.add_documents(new_docs)
+        num_tokens = len(self.dictionary.items())
+        print('Number of unique tokens in dictionary: ' + str(num_tokens))
+
+        print('Updating corpus ...')
+        with self.metrics.stage('corpus'):
+            new_corpus = [self.dictionary.doc2bow(text) for text in new_docs]
+            if self.stream_dir:
+                path = self.stream_dir + os.sep + 'corpus.mm'
+                gensim.corpora.MmCorpus.serialize(path + '.tmp',
+                        itertools.chain(self.corpus, new_corpus))
+                os.rename(path + '.tmp', path)
+                os.rename(path + '.tmp.index', path + '.index')
+                self.corpus = gensim.corpora.MmCorpus(path)
+            else:
+                self.corpus += new_corpus
+        return new_corpus
+
+    def iter_docs(self, start=0):
+        '''
+        Generate tokens from document store without stop words.
         '''
         unwanted_tags = ['LET', 'LID', 'VZ', 'VG']
-        for doc in doc_list:
-            if self.pos_tag:
-                yield (t for t in doc if t.split('/')[0] not in stop_list and
-                        len(t.split('/')[0]) > 2 and t.split('/')[1] not in
-                        unwanted_tags)
-            else:
-                yield (t for t in doc if t not in stop_list and len(t) > 2)
+        stop_list = set(self.stop_list)
+        store = self.doc_store
+        docs = store[start:] if start else store
+        if self.pos_tag:
+            wanted_lemmas = [len(l) > 2 and l not in stop_list for l in
+                    store.lemmas]
+            wanted_tags = [t not in unwanted_tags for t in store.tags]
+            for lemma_ids, tag_ids in docs:
+                yield (store.get_token(l << TAG_BITS | t) for l, t in
+                        itertools.izip(lemma_ids, tag_ids) if
+                        wanted_lemmas[l] and wanted_tags[t])
+        else:
+            wanted = {}
+            for lemma_ids, tag_ids in docs:
+                tokens = [store.get_token(l << TAG_BITS | t) for l, t in
+                        itertools.izip(lemma_ids, tag_ids)]
+                for t in tokens:
+                    if t not in wanted:
+                        wanted[t] = len(t) > 2 and t not in stop_list
+                yield (t for t in tokens if wanted[t])
+
+    @property
+    def doc_list(self):
+        '''
+        Get documents as lists of token strings.
+        '''
+        return [self.doc_store.get_tokens(doc) for doc in self.doc_store]
+
+    def get_index(self):
+        '''
+        Create positional inverted index of document token ids.
+        '''
+        if self.index is None:
+            print('Generating index ...')
+            with self.metrics.stage('index'):
+                self.index = {}
+                for i, (lemma_ids, tag_ids) in enumerate(self.doc_store):
+                    for j, (l, t) in enumerate(itertools.izip(lemma_ids,
+                            tag_ids)):
+                        token_id = l << TAG_BITS | t
+                        if token_id in self.index:
+                            self.index[token_id].append((i, j))
+                        else:
+                            self.index[token_id] = [(i, j)]
+        return self.index
 
     def decode(self, s):
         '''
@@ -249,14 +845,25 @@ class DocumentReader(object):
                 continue
         return decoded
 
-    def save_docs(self, output_dir):
+    def save_docs(self, output_dir, doc_format='json'):
         '''
-        Save processed documents to file.
+        Save processed documents to file, as json or in binary format.
         '''
-        data = {'docs': self.doc_list}
-        with io.open(output_dir + os.sep + 'docs.json', 'w',
-                encoding='utf-8') as f:
-            f.write(unicode(json.dumps(data, ensure_ascii=False)))
+        if doc_format == 'binary':
+            self.doc_store.save(output_dir + os.sep + 'docs')
+        else:
+            with io.open(output_dir + os.sep + 'docs.json', 'w',
+                    encoding='utf-8') as f:
+                # Write documents one by one, they may not fit in memory
+                f.write(u'{"docs": [')
+                for i, doc in enumerate(self.doc_store):
+                    if i:
+                        f.write(u', ')
+                    f.write(unicode(json.dumps(self.doc_store.get_tokens(
+                            doc), ensure_ascii=False)))
+                f.write(u']}')
+        if self.regex_list:
+            self.normalizer.save_stats(output_dir)
         if self.log:
             with open(output_dir + os.sep + 'log' + '.txt', 'w') as f:
                 for line in self.log:
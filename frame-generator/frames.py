@@ -19,84 +19,524 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import itertools
 import math
-import operator
+import multiprocessing
+import numpy
 import os
+import scipy.sparse
+import time
 import unicodecsv as csv
 
+from documents import TAG_BITS
+from documents import TAG_MASK
 
-class FrameList(object):
+# Number of tokens encoded per batch by the NumPy engine
+BATCH_SIZE = 1000000
+
+# Number of tokens counted in a single process to estimate the time of
+# counting all keyword windows, to decide whether to count in parallel
+SAMPLE_TOKENS = 10000
+
+# FrameCounter and keywords shared with worker processes in parallel mode
+_frame_counter = None
+_keyword_ids = None
+
+# Seconds to start a worker process and collect its results
+_process_cost = None
+
+
+def _count_occurrences(shard):
+    '''
+    Count frame words for a shard of keyword occurrences in the index.
+    '''
+    index = _frame_counter.doc_reader.get_index()
+    docs = _frame_counter.doc_reader.doc_store
+    counts = {}
+    for k, start, end in shard:
+        frame = counts.setdefault(k, {})
+        for i, j in index[k][start:end]:
+            _frame_counter.count_window(frame, docs[i], j)
+    return pack_counts(counts, _frame_counter.window_size)
+
+
+def _count_shard(shard):
+    '''
+    Count frame words for all keywords in a shard of documents.
+    '''
+    start, end = shard
+    return pack_counts(_frame_counter.count_docs(_keyword_ids,
+            _frame_counter.doc_reader.doc_store[start:end]),
+            _frame_counter.window_size)
+
+
+def pack_counts(counts, window_size):
+    '''
+    Convert distance counts of each keyword to an array of word ids and an
+    array of counts, which are much faster to pass between processes.
+    '''
+    packed = {}
+    for k, frame in counts.items():
+        words = numpy.fromiter(frame.iterkeys(), numpy.int64, len(frame))
+        distance_counts = numpy.fromiter(itertools.chain.from_iterable(
+                frame.itervalues()), numpy.int32, len(frame) * window_size)
+        packed[k] = (words, distance_counts.reshape(len(frame), window_size))
+    return packed
+
+
+def get_process_cost():
+    '''
+    Measure the time to start a worker process and collect its results, once
+    per process.
+    '''
+    global _process_cost
+    if _process_cost is None:
+        start = time.time()
+        pool = multiprocessing.Pool(1)
+        try:
+            pool.map(abs, [0])
+        finally:
+            pool.close()
+            pool.join()
+        _process_cost = time.time() - start
+    return _process_cost
+
+
+def get_weights(window_size):
+    '''
+    Get score weights for all distances within the window.
+    '''
+    return [math.exp(d * -0.25) for d in range(1, window_size + 1)]
+
+
+class FrameCounter(object):
+    '''
+    Counter of frame words per distance in keyword windows.
+    '''
+
+    def __init__(self, doc_reader, window_direction=None, window_size=5,
+            frame_tags=[], workers=1):
+        '''
+        Set FrameCounter attributes.
+        '''
+        self.doc_reader = doc_reader
+        self.window_direction = window_direction
+        self.window_size = window_size
+        self.frame_tags = frame_tags
+        self.workers = workers
+
+        # Check which lemmas and tags meet frame criteria
+        store = self.doc_reader.doc_store
+        stop_list = set(self.doc_reader.stop_list)
+        self.frame_lemmas = [len(l) > 2 and l not in stop_list for l in
+                store.lemmas]
+        self.frame_tag_ids = [not frame_tags or t in frame_tags for t in
+                store.tags]
+
+    def count(self, keyword_ids, docs):
+        '''
+        Count frame words per distance for each keyword.
+        '''
+        if self.workers > 1 and self.is_parallel(keyword_ids, docs):
+            return self.count_parallel(keyword_ids, docs)
+        if self.doc_reader.stream_dir:
+            return self.count_docs(keyword_ids, docs)
+        return self.count_index(keyword_ids, docs)
+
+    def is_parallel(self, keyword_ids, docs):
+        '''
+        Check if counting in parallel saves more time than starting the
+        workers takes, estimating the time of counting in a single process
+        from a sample.
+        '''
+        if self.doc_reader.stream_dir:
+            lengths = docs.get_lengths()
+            total = sum(lengths)
+            if total <= SAMPLE_TOKENS:
+                return False
+            start = time.time()
+            n = 0
+            sample = 0
+            while sample < SAMPLE_TOKENS:
+                sample += lengths[n]
+                n += 1
+            self.count_docs(keyword_ids, docs[:n])
+        else:
+            index = self.doc_reader.get_index()
+            window_tokens = self.window_size * (1 if self.window_direction
+                    else 2)
+            occurrences = [index.get(k, []) for k in set(keyword_ids)]
+            total = sum(len(o) for o in occurrences) * window_tokens
+            if total <= SAMPLE_TOKENS:
+                return False
+            start = time.time()
+            frame = {}
+            sample = 0
+            for i, j in itertools.chain.from_iterable(occurrences):
+                if sample >= SAMPLE_TOKENS:
+                    break
+                self.count_window(frame, docs[i], j)
+                sample += window_tokens
+        seconds = (time.time() - start) * total / sample
+        cores = min(self.workers, multiprocessing.cpu_count())
+        return (seconds * (1 - 1.0 / cores) > self.workers *
+                get_process_cost())
+
+    def count_index(self, keyword_ids, docs):
+        '''
+        Count frame words for each keyword using the document index.
+        '''
+        index = self.doc_reader.get_index()
+        counts = {}
+        for k in keyword_ids:
+            frame = {}
+
+            # Visit only the occurrences of the keyword in the index
+            for i, j in index.get(k, []):
+                self.count_window(frame, docs[i], j)
+
+            counts[k] = frame
+        return counts
+
+    def count_docs(self, keyword_ids, docs):
+        '''
+        Count frame words for all keywords in a single pass over documents.
+        '''
+        counts = dict((k, {}) for k in keyword_ids)
+        for doc in docs:
+            lemma_ids, tag_ids = doc
+            for j in xrange(len(lemma_ids)):
+                token_id = lemma_ids[j] << TAG_BITS | tag_ids[j]
+                if token_id in counts:
+                    self.count_window(counts[token_id], doc, j)
+        return counts
+
+    def count_parallel(self, keyword_ids, docs):
+        '''
+        Count frame words for all keywords in parallel, in shards of keyword
+        occurrences using the index, or in shards of documents when
+        streaming.
+        '''
+        global _frame_counter, _keyword_ids
+
+        if self.doc_reader.stream_dir:
+            count_shard = _count_shard
+            shards = self.get_doc_shards(docs)
+        else:
+            count_shard = _count_occurrences
+            shards = self.get_occurrence_shards(keyword_ids)
+
+        # Workers inherit this FrameCounter and its documents when forked
+        _frame_counter = self
+        _keyword_ids = keyword_ids
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            parts = dict((k, []) for k in keyword_ids)
+            for partial in pool.imap_unordered(count_shard, shards):
+                for k, part in partial.items():
+                    parts[k].append(part)
+        finally:
+            pool.close()
+            pool.join()
+            _frame_counter = None
+            _keyword_ids = None
+
+        # Sum the distance counts of words counted in several shards
+        counts = {}
+        for k, k_parts in parts.items():
+            if not k_parts:
+                counts[k] = {}
+                continue
+            words = numpy.concatenate([p[0] for p in k_parts])
+            distance_counts = numpy.concatenate([p[1] for p in k_parts])
+            if len(k_parts) > 1 and len(words):
+                order = numpy.argsort(words, kind='mergesort')
+                words = words[order]
+                starts = numpy.flatnonzero(numpy.concatenate(([True],
+                        words[1:] != words[:-1])))
+                distance_counts = numpy.add.reduceat(distance_counts[order],
+                        starts)
+                words = words[starts]
+            counts[k] = dict(itertools.izip(words.tolist(),
+                    distance_counts.tolist()))
+        return counts
+
+    def get_occurrence_shards(self, keyword_ids):
+        '''
+        Split the occurrences of keywords in the index into a shard per
+        worker of equal size, as ranges of the occurrences of each keyword.
+        '''
+        index = self.doc_reader.get_index()
+        keyword_ids = [k for k in sorted(set(keyword_ids)) if k in index]
+        shard_size = max(-(-sum(len(index[k]) for k in keyword_ids) //
+                self.workers), 1)
+        shards = [[]]
+        size = 0
+        for k in keyword_ids:
+            start = 0
+            while start < len(index[k]):
+                if size == shard_size:
+                    shards.append([])
+                    size = 0
+                end = min(start + shard_size - size, len(index[k]))
+                shards[-1].append((k, start, end))
+                size += end - start
+                start = end
+        return shards
+
+    def get_doc_shards(self, docs):
+        '''
+        Split documents into a shard per worker of roughly equal token
+        counts.
+        '''
+        lengths = docs.get_lengths()
+        shard_size = max(sum(lengths) // self.workers, 1)
+        shards = []
+        start = 0
+        shard_tokens = 0
+        for i, length in enumerate(lengths):
+            shard_tokens += length
+            if shard_tokens >= shard_size:
+                shards.append((start, i + 1))
+                start = i + 1
+                shard_tokens = 0
+        if start < len(docs):
+            shards.append((start, len(docs)))
+        return shards
+
+    def count_window(self, frame, doc, j):
+        '''
+        Count frame words per distance in the window of a keyword.
+        '''
+        lemma_ids, tag_ids = doc
+
+        # Get the window indices, clipped to the document
+        left = range(max(j - self.window_size, 0), j)
+        right = range(j + 1, min(j + self.window_size + 1, len(lemma_ids)))
+        if self.window_direction == 'left':
+            window_indices = left
+        elif self.window_direction == 'right':
+            window_indices = right
+        else:
+            window_indices = left + right
+
+        # Find the words in the keyword window that meet frame criteria
+        for p in window_indices:
+            l, t = lemma_ids[p], tag_ids[p]
+            if not self.frame_lemmas[l] or not self.frame_tag_ids[t]:
+                continue
+
+            # Count occurrences of the word per distance
+            w = l << TAG_BITS | t
+            if w not in frame:
+                frame[w] = [0] * self.window_size
+            frame[w][abs(j - p) - 1] += 1
+
+
+class WindowCounts(object):
+    '''
+    Counts of words of all tags per distance left and right of keywords,
+    shared by frame lists with different windows and frame tags.
+    '''
+
+    def __init__(self, doc_reader, keyword_ids, window_size=5, workers=1):
+        '''
+        Count words in the largest window left and right of each keyword.
+        '''
+        self.window_size = window_size
+        self.counts = {}
+        with doc_reader.metrics.stage('window counts'):
+            for direction in ['left', 'right']:
+                print('Counting words ' + direction + ' of keywords ...')
+                counter = FrameCounter(doc_reader, direction, window_size,
+                        workers=workers)
+                self.counts[direction] = counter.count(keyword_ids,
+                        doc_reader.doc_store)
+
+
+class FrameList(FrameCounter):
     '''
     List of generated frames.
     '''
 
     def __init__(self, doc_reader, keyword_list, window_direction=None,
-        window_size=5, frame_size=10, frame_tags=[]):
+        window_size=5, frame_size=10, frame_tags=[], engine='index',
+        workers=1, window_counts=None):
         '''
         Set FrameList attributes.
         '''
-        self.doc_reader = doc_reader
+        super(FrameList, self).__init__(doc_reader, window_direction,
+                window_size, frame_tags, workers)
         self.keyword_list = keyword_list
-        self.window_direction = window_direction
-        self.window_size = window_size
         self.frame_size = frame_size
-        self.frame_tags = frame_tags
+        self.engine = engine
+        self.window_counts = window_counts
 
-        self.frames = self.generate_frames(self.keyword_list.keywords,
-                self.doc_reader.doc_list)
+        with self.doc_reader.metrics.stage('frames'):
+            store = self.doc_reader.doc_store
+            self.keyword_ids = [store.get_token_id(k[0]) for k in
+                    self.keyword_list.keywords]
+            self.frames = self.generate_frames(self.keyword_ids, store)
 
-    def generate_frames(self, keywords, docs):
+    def generate_frames(self, keyword_ids, docs):
         '''
         Generate frames.
         '''
         print('Generating frames ...')
 
-        frames = []
-        for k in keywords:
+        if self.engine == 'numpy' and not self.window_counts:
+            frames = self.generate_matrix_frames(keyword_ids, docs)
+        else:
+            if self.window_counts:
+                counts = self.get_window_counts(keyword_ids)
+            else:
+                counts = self.count(keyword_ids, docs)
+
+            # Calculate score for each word from its distance counts
+            weights = get_weights(self.window_size)
+            frames = []
+            for k in keyword_ids:
+                frames.append([(w, sum(c * weights[d] for d, c in
+                        enumerate(dc))) for w, dc in counts[k].items()])
+
+        # Build token strings for the highest scoring words only
+        store = self.doc_reader.doc_store
+        return [self.sort_frame([(store.get_token(w), score) for w, score in
+                frame]) for frame in frames]
+
+    def get_window_counts(self, keyword_ids):
+        '''
+        Get frame word counts per distance for each keyword from shared
+        window counts.
+        '''
+        assert self.window_size <= self.window_counts.window_size, \
+                'Window larger than window of shared counts'
+        if self.window_direction in ['left', 'right']:
+            directions = [self.window_direction]
+        else:
+            directions = ['left', 'right']
+
+        counts = {}
+        for k in keyword_ids:
             frame = {}
-            for doc in docs:
-                for i, t in enumerate(doc):
-
-                    # Find all occurences of the keyword in the doc bow
-                    if t == k[0]:
-                        # Get the window indeces
-                        if self.window_direction == 'left':
-                            window_indices = range(i - self.window_size, i)
-                        elif self.window_direction == 'right':
-                            window_indices = range(i + 1,
-                                    i + self.window_size + 1)
-                        else:
-                            window_indices = (range(i - self.window_size, i) +
-                                    range(i + 1, i + self.window_size + 1))
-
-                        # Find the words in the keyword window
-                        for w in [word for word in doc if doc.index(word)
-                                in window_indices]:
-
-                            # Check if word meets frame criteria
-                            if (len(w.split('/')[0]) > 2 and w.split('/')[0] not
-                                    in self.doc_reader.stop_list):
-                                if (not self.frame_tags or w.split('/')[1] in
-                                        self.frame_tags):
-
-                                    # Calculate score for selected word
-                                    distance = abs(i - doc.index(w))
-                                    score = math.exp(distance * -0.25)
-
-                                    # Add word and score to frame dict
-                                    if w in frame:
-                                        frame[w] += score
-                                    else:
-                                        frame[w] = score
-
-            # Sort frame by highest score
-            sorted_frame = sorted(frame.items(), key=operator.itemgetter(1),
-                    reverse=True)[:self.frame_size]
-
-            frames.append(sorted_frame)
+            for direction in directions:
+                for w, dc in self.window_counts.counts[direction].get(k,
+                        {}).items():
+                    # Skip words of other tags or only further away
+                    dc = dc[:self.window_size]
+                    if not self.frame_tag_ids[w & TAG_MASK] or not any(dc):
+                        continue
+                    if w in frame:
+                        frame[w] = [a + b for a, b in zip(frame[w], dc)]
+                    else:
+                        frame[w] = dc
+            counts[k] = frame
+        return counts
+
+    def generate_matrix_frames(self, keyword_ids, docs):
+        '''
+        Generate frames for all keywords at once with NumPy.
+        '''
+        weights = get_weights(self.window_size)
+
+        if self.window_direction == 'left':
+            directions = [-1]
+        elif self.window_direction == 'right':
+            directions = [1]
+        else:
+            directions = [-1, 1]
+
+        # Sorted keyword token ids and their rows for lookup
+        keyword_rows = sorted((k, i) for i, k in enumerate(keyword_ids) if
+                k is not None)
+        keys = numpy.array([k for k, i in keyword_rows] or [-1],
+                dtype=numpy.int64)
+        key_rows = numpy.array([i for k, i in keyword_rows] or [-1],
+                dtype=numpy.int64)
+        frame_lemmas = numpy.array(self.frame_lemmas, dtype=bool)
+        frame_tag_ids = numpy.array(self.frame_tag_ids, dtype=bool)
+
+        rows = [[] for d in range(self.window_size)]
+        cols = [[] for d in range(self.window_size)]
+
+        def count_batch(lemma_ids, tag_ids, lengths):
+            # Get flat token and document id arrays for the batch
+            lemma_ids = numpy.frombuffer(lemma_ids, dtype=numpy.int32)
+            tag_ids = numpy.frombuffer(tag_ids, dtype=numpy.uint8)
+            tokens = lemma_ids.astype(numpy.int64) << TAG_BITS | tag_ids
+            doc_ids = numpy.repeat(numpy.arange(len(lengths)), lengths)
+            valid_words = frame_lemmas[lemma_ids] & frame_tag_ids[tag_ids]
+
+            # Find the keyword positions and their rows
+            i = numpy.searchsorted(keys, tokens).clip(0, len(keys) - 1)
+            positions = numpy.flatnonzero(keys[i] == tokens)
+            token_rows = key_rows[i]
+
+            # Collect window words that meet frame criteria per distance
+            for d in range(1, self.window_size + 1):
+                for direction in directions:
+                    p = positions
+                    q = p + direction * d
+                    valid = (q >= 0) & (q < len(tokens))
+                    p, q = p[valid], q[valid]
+                    valid = (doc_ids[p] == doc_ids[q]) & valid_words[q]
+                    p, q = p[valid], q[valid]
+                    rows[d - 1].append(token_rows[p])
+                    cols[d - 1].append(tokens[q])
+
+        batch_lemma_ids = array.array('i')
+        batch_tag_ids = array.array('B')
+        lengths = []
+        for lemma_ids, tag_ids in docs:
+            batch_lemma_ids.extend(lemma_ids)
+            batch_tag_ids.extend(tag_ids)
+            lengths.append(len(lemma_ids))
+            if len(batch_lemma_ids) >= BATCH_SIZE:
+                count_batch(batch_lemma_ids, batch_tag_ids, lengths)
+                batch_lemma_ids = array.array('i')
+                batch_tag_ids = array.array('B')
+                lengths = []
+        if len(batch_lemma_ids):
+            count_batch(batch_lemma_ids, batch_tag_ids, lengths)
+
+        # Map window word token ids to matrix columns
+        empty = [numpy.zeros(0, dtype=numpy.int64)]
+        rows = [numpy.concatenate(r + empty) for r in rows]
+        cols = [numpy.concatenate(c + empty) for c in cols]
+        words, cols = numpy.unique(numpy.concatenate(cols),
+                return_inverse=True)
+        cols = numpy.split(cols, numpy.cumsum([len(r) for r in rows])[:-1])
+
+        # Weigh sparse keyword x vocabulary count matrices per distance
+        shape = (len(keyword_ids), len(words))
+        scores = scipy.sparse.csr_matrix(shape)
+        for d in range(self.window_size):
+            counts = scipy.sparse.coo_matrix((numpy.ones(len(rows[d])),
+                    (rows[d], cols[d])), shape=shape).tocsr()
+            scores = scores + counts * weights[d]
+
+        # Select the highest scoring words per keyword
+        frames = []
+        for i in range(len(keyword_ids)):
+            start, end = scores.indptr[i], scores.indptr[i + 1]
+            data = scores.data[start:end]
+            indices = scores.indices[start:end]
+            if len(data) > self.frame_size > 0:
+                top = numpy.argpartition(-data, self.frame_size - 1)
+                cutoff = data[top[self.frame_size - 1]]
+                indices, data = indices[data >= cutoff], data[data >= cutoff]
+            frames.append([(int(words[j]), float(score)) for j, score in
+                    zip(indices, data)])
 
         return frames
 
+    def sort_frame(self, frame):
+        '''
+        Sort frame by highest score, then alphabetically.
+        '''
+        return sorted(frame, key=lambda f: (-f[1], f[0]))[:self.frame_size]
+
     def print_frames(self):
         '''
         Print generated frames.
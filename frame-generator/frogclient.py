@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Frame Generator
+#
+# Copyright (C) 2016 Juliette Lonij, Koninklijke Bibliotheek -
+# National Library of the Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import random
+import requests
+import threading
+import time
+import zlib
+
+from multiprocessing.pool import ThreadPool
+
+
+class FrogClient(object):
+    '''
+    Concurrent client for the Frog web service.
+    '''
+
+    def __init__(self, url, max_requests=4, batch_size=10, max_batch_size=100,
+            target_time=5.0, retries=2, backoff=2.0, max_backoff=60.0,
+            timeout=120.0, batch=True):
+        '''
+        Set FrogClient attributes.
+        '''
+        self.url = url
+        self.batch_url = url.rstrip('/') + '/batch'
+        self.batch = batch
+        self.max_requests = max_requests
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.target_time = target_time
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.num_requests = 0
+        self.num_retries = 0
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pool = None
+        self.pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ['lock', 'local', 'pool', 'pid']:
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pool = None
+        self.pid = None
+
+    def get_pool(self):
+        '''
+        Get thread pool of the current process.
+        '''
+        if self.pid != os.getpid():
+            self.pool = ThreadPool(self.max_requests)
+            self.pid = os.getpid()
+        return self.pool
+
+    def close(self):
+        '''
+        Stop the threads of the current process, they are started again
+        when needed.
+        '''
+        if self.pool and self.pid == os.getpid():
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
+        self.pid = None
+
+    def get_session(self):
+        '''
+        Get keep-alive session of the current thread.
+        '''
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def tag_docs(self, docs):
+        '''
+        Tag documents given as lists of sentences.
+
+        Return a (tokens, error) pair per document, in the original order.
+        '''
+        tokens = [[] for doc in docs]
+        errors = [None] * len(docs)
+        slots = threading.Semaphore(self.max_requests)
+
+        # Create requests lazily, so each one gets the current batch size
+        # and no more than max_requests are in flight. A request to the
+        # batch endpoint can hold pieces of several documents.
+        def batches():
+            pieces = []
+            size = 0
+            for i, sentences in enumerate(docs):
+                start = 0
+                while start < len(sentences) and not errors[i]:
+                    end = start + max(1, self.batch_size - size)
+                    pieces.append((i, sentences[start:end]))
+                    size += len(pieces[-1][1])
+                    start = end
+                    if size >= self.batch_size or not self.batch:
+                        slots.acquire()
+                        yield pieces
+                        pieces = []
+                        size = 0
+            if pieces:
+                slots.acquire()
+                yield pieces
+
+        def tag(pieces):
+            try:
+                if self.batch:
+                    results = self.tag_pieces([p[1] for p in pieces])
+                    if results is not None:
+                        return zip([p[0] for p in pieces], results)
+                return [(i, self.tag_batch(sentences)) for i, sentences in
+                        pieces]
+            finally:
+                slots.release()
+
+        # Results are returned in request order
+        for results in self.get_pool().imap(tag, batches()):
+            for i, (batch_tokens, error) in results:
+                if error:
+                    if not errors[i]:
+                        print('Frog data ' + error + ', skipping document!')
+                    errors[i] = error
+                    tokens[i] = []
+                elif not errors[i]:
+                    tokens[i] += batch_tokens
+
+        return zip(tokens, errors)
+
+    def tag_batch(self, sentences):
+        '''
+        Tag batch of sentences, retrying with exponential backoff.
+        '''
+        start = time.time()
+        response = self.send('GET', self.url,
+                params={'text': ' '.join(sentences).encode('utf-8')})
+        if response is None:
+            self.adapt_batch_size(None)
+            return None, 'not found'
+        self.adapt_batch_size(time.time() - start)
+
+        data = response.content.decode('utf-8')
+        new_tokens = [line.split('\t') for line in data.split('\n') if
+                len(line)]
+        if not new_tokens or len(new_tokens[0]) != 10:
+            return None, 'invalid'
+        return [(t[2].lower(), t[4].split('(')[0]) for t in new_tokens if
+                len(t) == 10], None
+
+    def tag_pieces(self, pieces):
+        '''
+        Tag several lists of sentences with one request to the batch
+        endpoint.
+
+        Return a (tokens, error) pair per list, or None if the endpoint is
+        not available.
+        '''
+        start = time.time()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(json.dumps({'docs': pieces}))
+        data += compressor.flush()
+        response = self.send('POST', self.batch_url, data=data,
+                headers={'Content-Type': 'application/json',
+                'Content-Encoding': 'gzip'}, batch=True)
+        if response is not None and response.status_code in (404, 405):
+            with self.lock:
+                if self.batch:
+                    print('Frog batch endpoint not available, using ' +
+                            self.url)
+                self.batch = False
+            return None
+        if response is None:
+            self.adapt_batch_size(None)
+            return [(None, 'not found')] * len(pieces)
+        self.adapt_batch_size(time.time() - start)
+
+        # Documents are terminated by an empty line, failures are given
+        # as a single line starting with an exclamation mark
+        results = []
+        batch_tokens = []
+        error = None
+        for line in response.content.decode('utf-8').split('\n')[:-1]:
+            if not line:
+                results.append((None, error) if error else (batch_tokens,
+                        None))
+                batch_tokens = []
+                error = None
+            elif line.startswith('!'):
+                error = line[1:]
+            else:
+                t = line.split('\t')
+                batch_tokens.append((t[0].lower(), t[1]))
+        if len(results) != len(pieces):
+            return [(None, 'invalid')] * len(pieces)
+        return results
+
+    def send(self, method, url, batch=False, **kwargs):
+        '''
+        Send request, retrying with exponential backoff.
+
+        Return the response, or None if no data was received.
+        '''
+        for attempt in range(self.retries + 1):
+            if attempt:
+                print('Frog data not found, retrying ...')
+                with self.lock:
+                    self.num_retries += 1
+                time.sleep(self.get_backoff(attempt - 1))
+            with self.lock:
+                self.num_requests += 1
+            try:
+                response = self.get_session().request(method, url,
+                        timeout=self.timeout, **kwargs)
+                if batch and response.status_code in (404, 405):
+                    return response
+                response.raise_for_status()
+            except (requests.RequestException, IOError):
+                continue
+            if response.content:
+                return response
+        return None
+
+    def get_backoff(self, attempt):
+        '''
+        Get delay before retry, exponential with full jitter.
+        '''
+        return random.uniform(0, min(self.max_backoff,
+                self.backoff * 2 ** attempt))
+
+    def adapt_batch_size(self, elapsed):
+        '''
+        Grow batches while responses are fast, shrink them on failures.
+        '''
+        with self.lock:
+            if elapsed is None or elapsed > self.target_time:
+                self.batch_size = max(1, self.batch_size // 2)
+            elif elapsed < self.target_time / 2:
+                self.batch_size = min(self.max_batch_size,
+                        self.batch_size + 1)
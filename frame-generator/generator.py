@@ -20,26 +20,41 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import cache
+import codecs
+import copy
+import cPickle as pickle
 import documents
 import frames
+import inspect
+import itertools
 import keywords
 import models
 import os
 import sys
+import tempfile
 import time
 import unicodecsv as csv
 
+from metrics import Metrics
+
+# Keyword and frame arguments that can differ between the configurations of
+# generate_many
+SWEEP_ARGS = ['kcount', 'ktags', 'wdir', 'wsize', 'fsize', 'ftags']
+
 
 def save_settings(args, output_dir):
     '''
     Save settings to file.
     '''
+    topic_args = ['tcount', 'tsize', 'mallet', 'tchunk', 'tpasses', 'titers',
+            'teval', 'tworkers', 'tseed', 'tconv', 'miters', 'mopt']
     if args['gtype'] == 'topics':
-        output_args = ['gtype', 'dlen', 'tcount', 'tsize', 'mallet']
+        output_args = ['gtype', 'dlen'] + topic_args
     elif args['gtype'] == 'keywords' or args['gtype'] == 'frames':
         output_args = ['gtype', 'dlen', 'kmodel', 'kcount', 'ktags']
         if args['kmodel'] == 'lda':
-            output_args += ['tcount', 'tsize', 'mallet']
+            output_args += topic_args
         if args['gtype'] == 'frames':
             output_args += ['wdir', 'wsize', 'fsize', 'ftags']
 
@@ -50,9 +65,59 @@ def save_settings(args, output_dir):
         for arg in output_args:
             csv_writer.writerow([arg, str(args[arg])])
 
-def generate(gtype='frames', dlen=0, pos=True, tcount=10, tsize=10, mallet=None,
+def save_metrics(metrics, output_dir):
+    '''
+    Print metrics and save them to file.
+    '''
+    metrics.print_metrics()
+    if output_dir:
+        metrics.save_metrics(output_dir)
+
+def get_stage(stage_cache, stage, key, create):
+    '''
+    Get stage from cache, or create and cache it.
+    '''
+    if not stage_cache:
+        return create()
+    obj = stage_cache.get(stage, key)
+    if obj is not None:
+        print('Using cached ' + stage + ' ...')
+        return obj
+    obj = create()
+    stage_cache.put(stage, key, obj)
+    return obj
+
+def load_state(state_dir):
+    '''
+    Load document reader and topic list of a previous run, None if not saved.
+    '''
+    path = state_dir + os.sep + 'state.pickle'
+    if not os.path.isfile(path):
+        return None
+    print('Loading state ...')
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def save_state(state_dir, doc_reader, topic_list):
+    '''
+    Save document reader and topic list for incremental updates.
+    '''
+    print('Saving state ...')
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    path = state_dir + os.sep + 'state.pickle'
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump({'doc_reader': doc_reader, 'topic_list': topic_list}, f,
+                pickle.HIGHEST_PROTOCOL)
+    os.rename(path + '.tmp', path)
+
+def generate(gtype='frames', dlen=0, pos=True, tcount=10, tsize=10,
+            mallet=None, tchunk=1, tpasses=1, titers=50, teval=1,
+            tworkers=None, tseed=None, tconv=None, miters=1000, mopt=0,
             kmodel='lda', kcount=10, ktags=[], wdir=None, wsize=5, fsize=10,
-            ftags=[], input_dir='input', output_dir='output'):
+            ftags=[], fengine='index', workers=1, stream=False,
+            input_dir='input', output_dir='output', cache_dir=None,
+            state_dir=None, profile=False, dformat='json'):
     '''
     Generate topics, keywords or frames.
     '''
@@ -61,52 +126,262 @@ def generate(gtype='frames', dlen=0, pos=True, tcount=10, tsize=10, mallet=None,
         output_dir += os.sep + str(int(time.time()))
         os.makedirs(output_dir)
 
+    # Profile stages in a profile subdirectory of the output directory, or
+    # in the given directory
+    profile_dir = None
+    if profile:
+        if profile is not True:
+            profile_dir = profile
+        elif output_dir:
+            profile_dir = output_dir + os.sep + 'profile'
+        else:
+            profile_dir = tempfile.mkdtemp()
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        print('Saving profiles to: ' + profile_dir)
+    metrics = Metrics(profile_dir)
+
     # Save settings
     if output_dir:
         save_settings(locals(), output_dir)
 
-    # Generate document list, dictionary and corpus
-    doc_reader = documents.DocumentReader(input_dir, dlen, pos)
+    # Keep streamed documents and corpus on disk
+    stream_dir = None
+    if stream:
+        if state_dir:
+            stream_dir = state_dir + os.sep + 'stream'
+            if not os.path.isdir(stream_dir):
+                os.makedirs(stream_dir)
+        elif output_dir:
+            stream_dir = output_dir + os.sep + 'stream'
+            os.makedirs(stream_dir)
+        else:
+            stream_dir = tempfile.mkdtemp()
+
+    # Reuse Frog annotations from previous runs
+    frog_cache = None
+    if pos and cache_dir:
+        frog_cache = cache.FrogCache(cache_dir + os.sep + 'frog.db',
+                documents.FROG_URL + ' ' + documents.FROG_VERSION)
+
+    # Reuse stages of previous runs with the same input and parameters,
+    # unless updating the state of a previous run
+    stage_cache = None
+    if cache_dir and not state_dir:
+        stage_cache = cache.StageCache(cache_dir + os.sep + 'stages')
+        docs_key = stage_cache.get_key(cache.hash_files(input_dir), dlen, pos,
+                documents.FROG_URL, documents.FROG_VERSION)
+        topics_key = stage_cache.get_key(docs_key, tcount, tsize, mallet,
+                tchunk, tpasses, titers, teval, tworkers, tseed, tconv, miters,
+                mopt)
+        keywords_key = stage_cache.get_key(topics_key if kmodel != 'tf-idf'
+                else docs_key, kmodel, kcount, ktags)
+    else:
+        docs_key = topics_key = keywords_key = None
+
+    # Reuse Mallet corpora and models of previous runs
+    mallet_cache_dir = None
+    if mallet and cache_dir:
+        mallet_cache_dir = cache_dir + os.sep + 'mallet'
+
+    # Load state of a previous run and add new documents only
+    state = None
+    if state_dir:
+        with metrics.stage('state'):
+            state = load_state(state_dir)
+
+    # Documents of changed input files cannot be replaced in the saved state
+    if state:
+        changed = state['doc_reader'].get_changed_files(input_dir)
+        if changed:
+            print('Input files changed, rebuilding state: ' +
+                    ', '.join(changed))
+            state = None
+    new_corpus = None
+    if state:
+        doc_reader = state['doc_reader']
+        assert (doc_reader.doc_length, doc_reader.pos_tag) == (dlen, pos), \
+                'Document settings differ from saved state'
+        doc_reader.workers = workers
+        doc_reader.frog_cache = frog_cache
+        doc_reader.metrics = metrics
+        new_corpus = doc_reader.update(input_dir)
+
+    # Generate document list, dictionary and corpus, streamed documents
+    # are kept in stream_dir and are not cached
+    else:
+        doc_reader = get_stage(None if stream else stage_cache, 'documents',
+                docs_key, lambda: documents.DocumentReader(input_dir, dlen,
+                pos, stream_dir, workers, frog_cache=frog_cache,
+                metrics=metrics))
+        doc_reader.metrics = metrics
     if output_dir:
-        doc_reader.save_docs(output_dir)
+        with metrics.stage('output'):
+            doc_reader.save_docs(output_dir, dformat)
+
+    # Generate topics, or update topics of saved state with new documents
+    topic_list = None
+    if gtype == 'topics' or kmodel != 'tf-idf':
+        topic_list = state and state['topic_list']
+        if topic_list and (topic_list.num_topics,
+                topic_list.mallet_path) == (tcount, mallet):
+            topic_list.doc_reader = doc_reader
+            topic_list.num_words = tsize
+            topic_list.update(new_corpus)
+        else:
+            topic_list = get_stage(stage_cache, 'topics', topics_key,
+                    lambda: models.TopicList(doc_reader, tcount, tsize,
+                    mallet, tchunk, tpasses, titers, teval, tworkers, tseed,
+                    tconv, miters, mopt, mallet_cache_dir))
+            topic_list.doc_reader = doc_reader
+        if output_dir:
+            with metrics.stage('output'):
+                topic_list.save_topics(output_dir)
+
+    if state_dir:
+        with metrics.stage('state'):
+            save_state(state_dir, doc_reader, topic_list)
 
     # Generate only topics
     if gtype == 'topics':
-        topic_list = models.TopicList(doc_reader, tcount, tsize, mallet)
-        if output_dir:
-            topic_list.save_topics(output_dir)
+        save_metrics(metrics, output_dir)
         return topic_list, None, None
 
     # Generate keywords based on tf-idf scores
     if kmodel == 'tf-idf':
-        tfidf_list = models.TfIdfList(doc_reader)
-        keyword_list = keywords.KeywordList(doc_reader, kcount, ktags,
-                tfidf_list=tfidf_list)
-        if output_dir:
-            keyword_list.save_keywords(output_dir)
+        keyword_list = get_stage(stage_cache, 'keywords', keywords_key,
+                lambda: keywords.KeywordList(doc_reader, kcount, ktags,
+                tfidf_list=models.TfIdfList(doc_reader)))
 
     # Generate keywords based on topics
     else:
-        topic_list = models.TopicList(doc_reader, tcount, tsize, mallet)
-        if output_dir:
-            topic_list.save_topics(output_dir)
-        keyword_list = keywords.KeywordList(doc_reader, kcount, ktags,
-                topic_list=topic_list)
-        if output_dir:
+        keyword_list = get_stage(stage_cache, 'keywords', keywords_key,
+                lambda: keywords.KeywordList(doc_reader, kcount, ktags,
+                topic_list=topic_list))
+        keyword_list.topic_list = topic_list
+    keyword_list.doc_reader = doc_reader
+    if output_dir:
+        with metrics.stage('output'):
             keyword_list.save_keywords(output_dir)
 
     # Generate only keywords
     if gtype == 'keywords':
+        save_metrics(metrics, output_dir)
         return None, keyword_list, None
 
     # Generate frames based on generated keywords
     else:
         frame_list = frames.FrameList(doc_reader, keyword_list, wdir, wsize,
-                fsize, ftags)
+                fsize, ftags, fengine, workers)
         if output_dir:
-            frame_list.save_frames(output_dir)
+            with metrics.stage('output'):
+                frame_list.save_frames(output_dir)
+        save_metrics(metrics, output_dir)
         return None, keyword_list, frame_list
 
+def generate_many(configs, output_dir='output', **kwargs):
+    '''
+    Generate keywords and frames for several configurations, sharing the
+    documents, topic or tf-idf model and keyword window counts.
+
+    Each configuration is a dict of keyword and frame arguments (see
+    SWEEP_ARGS) overriding those in kwargs. Results of each configuration
+    are saved in a numbered subdirectory of the output directory.
+    '''
+    assert all(set(config) <= set(SWEEP_ARGS) for config in configs), \
+            'Only keyword and frame arguments can differ'
+
+    # Create output directory
+    if output_dir == 'output':
+        output_dir += os.sep + str(int(time.time()))
+        os.makedirs(output_dir)
+
+    # Generate documents, model and keywords of the shared arguments once
+    args = inspect.getcallargs(generate, **kwargs)
+    args['gtype'] = 'keywords'
+    args['output_dir'] = output_dir
+    _, keyword_list, _ = generate(**args)
+    doc_reader = keyword_list.doc_reader
+    topic_list = keyword_list.topic_list
+    tfidf_list = None
+    if args['kmodel'] == 'tf-idf':
+        tfidf_list = keyword_list.tfidf_list or models.TfIdfList(doc_reader)
+
+    # Generate keywords once per keyword tag selection, with the largest
+    # keyword count, keyword lists of smaller counts are its first keywords
+    configs = [dict(args, gtype='frames', **config) for config in configs]
+    keyword_lists = {}
+    for config in configs:
+        key = tuple(config['ktags'])
+        if key in keyword_lists:
+            continue
+        kcount = max(c['kcount'] for c in configs if tuple(c['ktags']) ==
+                key)
+        if key == tuple(args['ktags']) and kcount <= args['kcount']:
+            keyword_lists[key] = keyword_list
+        else:
+            keyword_lists[key] = keywords.KeywordList(doc_reader, kcount,
+                    config['ktags'], topic_list=topic_list,
+                    tfidf_list=tfidf_list)
+
+    # Count words in the largest window of all keywords once
+    store = doc_reader.doc_store
+    keyword_ids = set()
+    for k_list in keyword_lists.values():
+        keyword_ids.update([store.get_token_id(k[0]) for k in
+                k_list.keywords])
+    keyword_ids.discard(None)
+    window_counts = frames.WindowCounts(doc_reader, sorted(keyword_ids),
+            max(config['wsize'] for config in configs), args['workers'])
+
+    results = []
+    for i, config in enumerate(configs):
+        config_keywords = copy.copy(keyword_lists[tuple(config['ktags'])])
+        config_keywords.doc_reader = doc_reader
+        config_keywords.topic_list = topic_list
+        config_keywords.tfidf_list = tfidf_list
+        config_keywords.num_keywords = config['kcount']
+        config_keywords.keywords = config_keywords.keywords[:config['kcount']]
+        frame_list = frames.FrameList(doc_reader, config_keywords,
+                config['wdir'], config['wsize'], config['fsize'],
+                config['ftags'], window_counts=window_counts)
+        if output_dir:
+            config_dir = output_dir + os.sep + str(i + 1).zfill(
+                    len(str(len(configs))))
+            os.makedirs(config_dir)
+            with doc_reader.metrics.stage('output'):
+                save_settings(config, config_dir)
+                config_keywords.save_keywords(config_dir)
+                frame_list.save_frames(config_dir)
+        results.append((config_keywords, frame_list))
+
+    save_metrics(doc_reader.metrics, output_dir)
+    return results
+
+def get_grid(grid):
+    '''
+    Get configurations for all combinations of argument values, given as
+    name=value,value,... strings. Tags are joined with +, use both for
+    both window directions and all for all tags.
+    '''
+    names = []
+    values = []
+    for arg in grid:
+        name, _, value_list = arg.partition('=')
+        assert name in SWEEP_ARGS, 'Unknown grid argument: ' + name
+        names.append(name)
+        values.append([])
+        for value in value_list.split(','):
+            if name in ['kcount', 'wsize', 'fsize']:
+                value = int(value)
+            elif name in ['ktags', 'ftags']:
+                value = [] if value == 'all' else value.split('+')
+            elif value == 'both':
+                value = None
+            values[-1].append(value)
+    return [dict(zip(names, combination)) for combination in
+            itertools.product(*values)]
+
 if __name__ == '__main__':
     if sys.stdout.encoding != 'UTF-8':
         sys.stdout = codecs.getwriter('utf-8')(sys.stdout, 'strict')
@@ -122,6 +397,8 @@ if __name__ == '__main__':
             help='number of sentences per document')
     parser.add_argument('--nopos', required=False, action='store_false',
             help='do not apply pos-tagging')
+    parser.add_argument('--dformat', required=False, type=str,
+            default='json', help='format of saved documents: json or binary')
 
     # Topics arguments
     parser.add_argument('--tcount', required=False, type=int, default=10,
@@ -130,6 +407,24 @@ if __name__ == '__main__':
             help='number of words per topic')
     parser.add_argument('--mallet', required=False, type=str,
             help='path to Mallet executable')
+    parser.add_argument('--tchunk', required=False, type=int, default=1,
+            help='number of documents per Gensim LDA training chunk')
+    parser.add_argument('--tpasses', required=False, type=int, default=1,
+            help='number of Gensim LDA training passes over the corpus')
+    parser.add_argument('--titers', required=False, type=int, default=50,
+            help='number of Gensim LDA inference iterations per document')
+    parser.add_argument('--teval', required=False, type=int, default=1,
+            help='number of chunks between perplexity estimates, 0 for none')
+    parser.add_argument('--tworkers', required=False, type=int,
+            help='number of LDA worker processes or Mallet threads')
+    parser.add_argument('--tseed', required=False, type=int,
+            help='random seed for LDA')
+    parser.add_argument('--tconv', required=False, type=float,
+            help='stop training passes when perplexity changes less')
+    parser.add_argument('--miters', required=False, type=int, default=1000,
+            help='number of Mallet sampling iterations')
+    parser.add_argument('--mopt', required=False, type=int, default=0,
+            help='Mallet iterations between hyperparameter optimization')
 
     # Keywords arguments
     parser.add_argument('--kmodel', required=False, type=str, default='lda',
@@ -148,17 +443,51 @@ if __name__ == '__main__':
             help='number of words per frame')
     parser.add_argument('--ftags', required=False, type=str, nargs='*',
             default=[], help='frame pos-tags')
+    parser.add_argument('--fengine', required=False, type=str,
+            default='index', help='frame engine: index or numpy')
+
+    # Processing arguments
+    parser.add_argument('--workers', required=False, type=int, default=1,
+            help='number of worker processes for ingestion and frames')
+    parser.add_argument('--stream', required=False, action='store_true',
+            help='keep documents and corpus on disk instead of in memory')
+    parser.add_argument('--no-cache', required=False, action='store_true',
+            help='do not use or update cached results')
+    parser.add_argument('--state', required=False, type=str,
+            help='directory of state to update with new documents')
+    parser.add_argument('--profile', required=False, action='store_true',
+            help='save profiles of each stage in the output directory')
+    parser.add_argument('--grid', required=False, type=str, nargs='*',
+            help='generate frames for all combinations of keyword and ' +
+            'frame arguments, e.g. wsize=3,5 wdir=left,both ftags=ADJ+WW,all')
 
     args = parser.parse_args()
 
-    topic_list, keyword_list, frame_list = generate(gtype=vars(args)['gtype'],
+    kwargs = dict(gtype=vars(args)['gtype'],
             dlen=vars(args)['dlen'], pos=vars(args)['nopos'],
             tcount=vars(args)['tcount'], tsize=vars(args)['tsize'],
-            mallet=vars(args)['mallet'], kmodel=vars(args)['kmodel'],
+            mallet=vars(args)['mallet'], tchunk=vars(args)['tchunk'],
+            tpasses=vars(args)['tpasses'], titers=vars(args)['titers'],
+            teval=vars(args)['teval'], tworkers=vars(args)['tworkers'],
+            tseed=vars(args)['tseed'], tconv=vars(args)['tconv'],
+            miters=vars(args)['miters'], mopt=vars(args)['mopt'],
+            kmodel=vars(args)['kmodel'],
             kcount=vars(args)['kcount'], ktags=vars(args)['ktags'],
             fsize=vars(args)['fsize'], ftags=vars(args)['ftags'],
-            wdir=vars(args)['wdir'], wsize=vars(args)['wsize'])
+            fengine=vars(args)['fengine'], wdir=vars(args)['wdir'],
+            wsize=vars(args)['wsize'], workers=vars(args)['workers'],
+            stream=vars(args)['stream'],
+            cache_dir=None if vars(args)['no_cache'] else 'cache',
+            state_dir=vars(args)['state'], profile=vars(args)['profile'],
+            dformat=vars(args)['dformat'])
+
+    if vars(args)['grid']:
+        results = generate_many(get_grid(vars(args)['grid']), **kwargs)
+        print('Frames generated for ' + str(len(results)) +
+                ' configurations')
+        sys.exit()
 
+    topic_list, keyword_list, frame_list = generate(**kwargs)
     if frame_list:
         frame_list.print_frames()
     elif keyword_list:
@@ -20,11 +20,13 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import gensim
-import math
-import operator
+import numpy
 import os
 import unicodecsv as csv
 
+# Number of documents summed per sparse matrix
+CHUNK_SIZE = 10000
+
 
 class KeywordList(object):
     '''
@@ -42,56 +44,76 @@ class KeywordList(object):
         self.topic_list = topic_list
         self.tfidf_list = tfidf_list
 
-        self.keywords = self.generate_keywords()
+        with self.doc_reader.metrics.stage('keywords'):
+            self.keywords = self.generate_keywords()
+
+    def __getstate__(self):
+        # Document reader and models are cached separately
+        state = self.__dict__.copy()
+        for attr in ['doc_reader', 'topic_list', 'tfidf_list']:
+            state[attr] = None
+        return state
 
     def generate_keywords(self):
         '''
         Generate keywords.
         '''
         print('Generating keywords ...')
-        keywords = {}
+        dictionary = self.doc_reader.dictionary
+        scores = numpy.zeros(len(dictionary))
+        candidates = numpy.zeros(len(dictionary), dtype=bool)
 
         if self.tfidf_list:
-            for doc in self.tfidf_list.scores:
-                for t in doc:
-                    key = self.doc_reader.dictionary.get(t[0])
-                    score = t[1]
-                    if key in keywords:
-                        keywords[key] += score
-                    else:
-                        keywords[key] = score
+            # Sum of tf-idf scores for token in all documents, in chunks
+            for chunk in gensim.utils.grouper(self.tfidf_list.scores,
+                    CHUNK_SIZE):
+                matrix = gensim.matutils.corpus2csc(chunk,
+                        num_terms=len(dictionary))
+                scores += numpy.asarray(matrix.sum(axis=1)).ravel()
+                candidates |= matrix.getnnz(axis=1) > 0
 
         elif self.topic_list:
             # Sum of probabilities for token in all topics
             for topic in self.topic_list.topics:
                 for t in topic:
-                    if t[1] in keywords:
-                        keywords[t[1]] += t[0]
-                    else:
-                        keywords[t[1]] = t[0]
+                    token_id = dictionary.token2id[t[1]]
+                    scores[token_id] += t[0]
+                    candidates[token_id] = True
 
             # Probability for each token multiplied by token frequency
-            matrix = gensim.matutils.corpus2csc(self.doc_reader.corpus)
-            for token, pr in keywords.items():
-                for dict_tuple in self.doc_reader.dictionary.items():
-                    if dict_tuple[1] == token:
-                        token_index = dict_tuple[0]
-                        break
-                token_row = matrix.getrow(token_index)
-                token_freq = token_row.sum(1).item()
-                keywords[token] = pr * math.log(token_freq)
-
-        # Sort keywords by highest score
-        sorted_keywords = sorted(keywords.items(), key=operator.itemgetter(1),
-                reverse=True)
+            token_freqs = self.get_token_frequencies()
+            scores[candidates] *= numpy.log(token_freqs[candidates])
 
         # Filter wanted keyword tags
         if self.keyword_tags:
-            sorted_keywords = [k for k in sorted_keywords if k[0].split('/')[1]
-                    in self.keyword_tags]
+            candidates &= numpy.array([dictionary[i].partition('/')[2] in
+                    self.keyword_tags for i in range(len(dictionary))],
+                    dtype=bool)
+
+        # Select highest scoring keywords, including ties at the cutoff
+        candidates = numpy.flatnonzero(candidates)
+        if len(candidates) > self.num_keywords > 0:
+            top = numpy.argpartition(-scores[candidates], self.num_keywords - 1)
+            cutoff = scores[candidates[top[self.num_keywords - 1]]]
+            candidates = candidates[scores[candidates] >= cutoff]
+
+        # Sort keywords by highest score, then alphabetically
+        sorted_keywords = sorted([(dictionary[i], float(scores[i])) for i in
+                candidates], key=lambda k: (-k[1], k[0]))
 
         return sorted_keywords[:self.num_keywords]
 
+    def get_token_frequencies(self):
+        '''
+        Count frequency of each dictionary token in the corpus.
+        '''
+        token_freqs = numpy.zeros(len(self.doc_reader.dictionary))
+        for doc in self.doc_reader.corpus:
+            if doc:
+                token_ids, counts = zip(*doc)
+                token_freqs[list(token_ids)] += counts
+        return token_freqs
+
     def print_keywords(self):
         '''
         Print generated keywords.
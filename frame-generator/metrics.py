@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Frame Generator
+#
+# Copyright (C) 2016 Juliette Lonij, Koninklijke Bibliotheek -
+# National Library of the Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import resource
+import signal
+import sys
+import time
+
+
+def get_cpu_time():
+    '''
+    Get CPU time of this process and its finished child processes.
+    '''
+    times = os.times()
+    return sum(times[:4])
+
+
+def get_peak_rss():
+    '''
+    Get peak resident set size in MB of this process or its finished child
+    processes, whichever is largest.
+    '''
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports kilobytes, macOS bytes
+    return rss / (2.0 ** 20 if sys.platform == 'darwin' else 2.0 ** 10)
+
+
+class Metrics(object):
+    '''
+    Timings and counters of a run, and optionally profiles of its stages.
+    '''
+
+    def __init__(self, profile_dir=None, sample_interval=0.005):
+        '''
+        Set Metrics attributes.
+        '''
+        self.stages = collections.OrderedDict()
+        self.counters = {}
+
+        self.start_time = time.time()
+        self.start_cpu_time = get_cpu_time()
+
+        self.profile_dir = profile_dir
+        self.sample_interval = sample_interval
+        self.pid = os.getpid()
+        self.active = []
+        self.profilers = []
+        self.profiled = set()
+        self.samples = {}
+        self.sampling = False
+
+    def __getstate__(self):
+        # Profilers can't be pickled
+        state = self.__dict__.copy()
+        state['active'] = []
+        state['profilers'] = []
+        state['sampling'] = False
+        return state
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Measure wall and CPU time of a stage, adding to earlier runs of the
+        same stage. Nested stages are included in the enclosing one.
+
+        Peak memory is the peak of the process up to the end of the stage.
+        '''
+        # Stages in worker processes are not profiled
+        profile = self.profile_dir and os.getpid() == self.pid
+        if profile:
+            self.start_profiler(name)
+        start_time = time.time()
+        start_cpu_time = get_cpu_time()
+        try:
+            yield
+        finally:
+            if profile:
+                self.stop_profiler(name)
+            if name not in self.stages:
+                self.stages[name] = collections.OrderedDict([('calls', 0),
+                        ('wall_time', 0.0), ('cpu_time', 0.0),
+                        ('peak_rss', 0.0)])
+            stage = self.stages[name]
+            stage['calls'] += 1
+            stage['wall_time'] += time.time() - start_time
+            stage['cpu_time'] += get_cpu_time() - start_cpu_time
+            stage['peak_rss'] = max(stage['peak_rss'], get_peak_rss())
+
+    def start_profiler(self, name):
+        '''
+        Profile stage, pausing the profiler of the enclosing stage.
+        '''
+        if self.profilers:
+            self.profilers[-1].disable()
+        elif not self.sampling:
+            self.start_sampling()
+        self.active.append(name)
+        self.profilers.append(cProfile.Profile())
+        self.profilers[-1].enable()
+
+    def stop_profiler(self, name):
+        '''
+        Save stage profile, resuming the profiler of the enclosing stage.
+        '''
+        profiler = self.profilers.pop()
+        profiler.disable()
+        self.active.pop()
+
+        # Add to profile of earlier runs of the same stage
+        path = self.profile_dir + os.sep + name + '.pstats'
+        stats = pstats.Stats(profiler)
+        if name in self.profiled:
+            stats.add(path)
+        stats.dump_stats(path)
+        self.profiled.add(name)
+
+        if self.profilers:
+            self.profilers[-1].enable()
+        elif self.sampling:
+            self.stop_sampling()
+            self.save_samples()
+
+    def start_sampling(self):
+        '''
+        Sample call stacks of the main thread at intervals of CPU time.
+        '''
+        try:
+            signal.signal(signal.SIGPROF, self.sample)
+        except ValueError:
+            # Signal handlers can only be set in the main thread
+            return
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.sample_interval,
+                self.sample_interval)
+        self.sampling = True
+
+    def stop_sampling(self):
+        '''
+        Stop sampling call stacks.
+        '''
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.sampling = False
+
+    def sample(self, signum, frame):
+        '''
+        Count call stack of the current frame under the current stage.
+        '''
+        stack = []
+        while frame:
+            code = frame.f_code
+            stack.append(os.path.splitext(os.path.basename(
+                    code.co_filename))[0] + ':' + code.co_name)
+            frame = frame.f_back
+        stack.append(self.active[-1] if self.active else 'none')
+        stack = ';'.join(reversed(stack))
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def save_samples(self):
+        '''
+        Save sampled call stacks in collapsed format, as used by flame
+        graph tools.
+        '''
+        with open(self.profile_dir + os.sep + 'stacks' + '.txt', 'w') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(stack + ' ' + str(count) + '\n')
+
+    def count(self, name, n=1):
+        '''
+        Add n to counter.
+        '''
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset_counters(self):
+        '''
+        Reset all counters.
+        '''
+        self.counters = {}
+
+    def add_counters(self, counters):
+        '''
+        Add counters, e.g. from a worker process.
+        '''
+        for name, n in counters.items():
+            self.count(name, n)
+
+    def get_metrics(self):
+        '''
+        Get stage timings, counters and totals of the run so far.
+        '''
+        return collections.OrderedDict([
+                ('wall_time', time.time() - self.start_time),
+                ('cpu_time', get_cpu_time() - self.start_cpu_time),
+                ('peak_rss', get_peak_rss()),
+                ('stages', self.stages),
+                ('counters', collections.OrderedDict(sorted(
+                        self.counters.items())))])
+
+    def print_metrics(self):
+        '''
+        Print stage timings and counters.
+        '''
+        metrics = self.get_metrics()
+        print('Stage\tCalls\tWall (s)\tCPU (s)\tPeak RSS (MB)')
+        for name, stage in metrics['stages'].items():
+            print(name + '\t' + str(stage['calls']) + '\t' + '%.3f' %
+                    stage['wall_time'] + '\t' + '%.3f' % stage['cpu_time'] +
+                    '\t' + '%.1f' % stage['peak_rss'])
+        print('total\t1\t' + '%.3f' % metrics['wall_time'] + '\t' + '%.3f' %
+                metrics['cpu_time'] + '\t' + '%.1f' % metrics['peak_rss'])
+        for name in sorted(metrics['counters']):
+            print(name + ': ' + str(metrics['counters'][name]))
+
+    def save_metrics(self, dir_name):
+        '''
+        Save metrics to file.
+        '''
+        with open(dir_name + os.sep + 'metrics' + '.json', 'w') as f:
+            json.dump(self.get_metrics(), f, indent=2, separators=(',', ': '))
@@ -19,10 +19,126 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import fcntl
 import gensim
+import hashlib
+import itertools
+import multiprocessing
 import os
+import shutil
 import unicodecsv as csv
 
+# Number of documents used to measure convergence
+CONVERGENCE_SAMPLE = 1000
+
+# Number of imported corpora kept in the Mallet cache
+MALLET_CACHE_SIZE = 10
+
+
+def get_corpus_hash(corpus, id2word):
+    '''
+    Get content hash of corpus and its tokens.
+    '''
+    sha1 = hashlib.sha1()
+    for i in sorted(id2word.keys()):
+        sha1.update(id2word[i].encode('utf-8') + '\n')
+    for bow in corpus:
+        sha1.update(' '.join(['%d:%d' % (i, n) for i, n in bow]) + '\n')
+    return sha1.hexdigest()
+
+
+class CachedLdaMallet(gensim.models.wrappers.LdaMallet):
+    '''
+    Mallet LDA model reusing imported corpora and trained models of earlier
+    runs.
+    '''
+
+    def __init__(self, mallet_path, corpus, cache_dir, seed=None, **kwargs):
+        '''
+        Set file prefixes from hashes of corpus and training parameters.
+        '''
+        corpus_dir = cache_dir + os.sep + get_corpus_hash(corpus,
+                kwargs['id2word'])
+        if not os.path.isdir(corpus_dir):
+            os.makedirs(corpus_dir)
+        self.corpus_prefix = corpus_dir + os.sep
+        self.seed = seed
+
+        params = [kwargs.get(k) for k in ['num_topics', 'alpha',
+                'optimize_interval', 'iterations', 'topic_threshold']]
+        prefix = self.corpus_prefix + hashlib.sha1(repr(params +
+                [seed])).hexdigest() + '_'
+
+        # Shared lock keeps other runs from evicting the corpus in use
+        with open(self.corpus_prefix + 'lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            self.evict(cache_dir, corpus_dir)
+            super(CachedLdaMallet, self).__init__(mallet_path,
+                    corpus=corpus, prefix=prefix, **kwargs)
+
+    def evict(self, cache_dir, corpus_dir):
+        '''
+        Mark corpus as used and remove least recently used corpora, unless
+        in use by other runs.
+        '''
+        os.utime(corpus_dir, None)
+        dir_names = sorted(os.listdir(cache_dir), key=lambda d:
+                os.path.getmtime(cache_dir + os.sep + d), reverse=True)
+        for dir_name in dir_names[MALLET_CACHE_SIZE:]:
+            path = cache_dir + os.sep + dir_name
+            try:
+                with open(path + os.sep + 'lock', 'a') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    shutil.rmtree(path, ignore_errors=True)
+            except IOError:
+                continue
+
+    def fcorpustxt(self):
+        return self.corpus_prefix + 'corpus.txt'
+
+    def fcorpusmallet(self):
+        return self.corpus_prefix + 'corpus.mallet'
+
+    def convert_input(self, corpus, infer=False, serialize_corpus=True):
+        '''
+        Convert corpus to Mallet format, unless converted before.
+        '''
+        done_path = self.fcorpusmallet() + '.done'
+        if not infer and os.path.exists(done_path):
+            print('Using cached Mallet corpus ...')
+            return
+        super(CachedLdaMallet, self).convert_input(corpus, infer,
+                serialize_corpus)
+        os.remove(self.fcorpustxt())
+        if not infer:
+            open(done_path, 'w').close()
+
+    def train(self, corpus):
+        '''
+        Train model, unless trained before with the same parameters.
+        '''
+        done_path = self.fstate() + '.done'
+        if os.path.exists(done_path):
+            print('Using cached Mallet model ...')
+        else:
+            self.convert_input(corpus, infer=False)
+            cmd = (self.mallet_path + ' train-topics --input %s ' +
+                    '--num-topics %s --alpha %s --optimize-interval %s ' +
+                    '--num-threads %s --output-state %s ' +
+                    '--output-doc-topics %s --output-topic-keys %s ' +
+                    '--num-iterations %s --inferencer-filename %s ' +
+                    '--doc-topics-threshold %s') % (self.fcorpusmallet(),
+                    self.num_topics, self.alpha, self.optimize_interval,
+                    self.workers, self.fstate(), self.fdoctopics(),
+                    self.ftopickeys(), self.iterations, self.finferencer(),
+                    self.topic_threshold)
+            if self.seed is not None:
+                cmd += ' --random-seed ' + str(self.seed)
+            gensim.utils.check_output(args=cmd, shell=True)
+            open(done_path, 'w').close()
+        self.word_topics = self.load_word_topics()
+        self.wordtopics = self.word_topics
+
 
 class TopicList(object):
     '''
@@ -30,7 +146,9 @@ class TopicList(object):
     '''
 
     def __init__(self, doc_reader, num_topics=10, num_words=10,
-            mallet_path=None):
+            mallet_path=None, chunksize=1, passes=1, iterations=50,
+            eval_every=1, workers=None, seed=None, convergence=None,
+            mallet_iterations=1000, optimize_interval=0, cache_dir=None):
         '''
         Set TopicList attributes.
         '''
@@ -38,21 +156,107 @@ class TopicList(object):
         self.num_topics = num_topics
         self.num_words = num_words
         self.mallet_path = mallet_path
+        self.chunksize = chunksize
+        self.passes = passes
+        self.iterations = iterations
+        self.eval_every = eval_every
+        self.workers = workers
+        self.seed = seed
+        self.convergence = convergence
+        self.mallet_iterations = mallet_iterations
+        self.optimize_interval = optimize_interval
+        self.cache_dir = cache_dir
+
+        with self.doc_reader.metrics.stage('topics'):
+            self.lda = self.get_model()
+            self.topics = self.get_topics()
+
+    def __getstate__(self):
+        # Document reader is cached separately
+        state = self.__dict__.copy()
+        state['doc_reader'] = None
+        return state
 
-        if mallet_path:
+    def get_model(self):
+        '''
+        Train LDA model on the corpus.
+        '''
+        if self.mallet_path:
             print('Generating Mallet LDA model ...')
-            lda = gensim.models.wrappers.LdaMallet(mallet_path,
-                    num_topics=num_topics, corpus=self.doc_reader.corpus,
-                    id2word=self.doc_reader.dictionary, workers=2)
+            params = {'num_topics': self.num_topics,
+                    'id2word': self.doc_reader.dictionary,
+                    'workers': self.workers or multiprocessing.cpu_count(),
+                    'iterations': self.mallet_iterations,
+                    'optimize_interval': self.optimize_interval}
+            if self.cache_dir:
+                return CachedLdaMallet(self.mallet_path,
+                        self.doc_reader.corpus, self.cache_dir, self.seed,
+                        **params)
+            return gensim.models.wrappers.LdaMallet(self.mallet_path,
+                    corpus=self.doc_reader.corpus, **params)
+
+        corpus = self.doc_reader.corpus
+        passes = 1 if self.convergence else self.passes
+        if (self.workers or 1) > 1:
+            # Multicore training doesn't support learning alpha
+            print('Generating Gensim multicore LDA model ...')
+            print('Multicore LDA model uses a symmetric alpha prior ' +
+                    'instead of learning it, use 1 worker to learn alpha')
+            if self.seed is not None:
+                print('Multicore LDA model is not reproducible with a seed, ' +
+                        'use 1 worker instead')
+            lda = gensim.models.LdaMulticore(corpus=corpus,
+                    id2word=self.doc_reader.dictionary,
+                    num_topics=self.num_topics, workers=self.workers,
+                    chunksize=self.chunksize, passes=passes,
+                    iterations=self.iterations, eval_every=self.eval_every,
+                    random_state=self.seed)
         else:
             print('Generating Gensim LDA model ...')
-            lda = gensim.models.LdaModel(corpus=self.doc_reader.corpus,
-                    id2word=self.doc_reader.dictionary, num_topics=num_topics,
-                    alpha='auto', chunksize=1, eval_every=1)
+            lda = gensim.models.LdaModel(corpus=corpus,
+                    id2word=self.doc_reader.dictionary,
+                    num_topics=self.num_topics, alpha='auto',
+                    chunksize=self.chunksize, passes=passes,
+                    iterations=self.iterations, eval_every=self.eval_every,
+                    random_state=self.seed)
 
-        topics = [t[1] for t in lda.show_topics(num_words=num_words,
-            num_topics=num_topics, formatted=False)]
-        self.topics = [[(i[1], i[0]) for i in t] for t in topics]
+        # Train one pass at a time until perplexity stops improving
+        if self.convergence:
+            sample = list(itertools.islice(corpus, CONVERGENCE_SAMPLE))
+            bound = lda.log_perplexity(sample)
+            for n in range(1, self.passes):
+                lda.update(corpus)
+                new_bound = lda.log_perplexity(sample)
+                if abs(new_bound - bound) < self.convergence * abs(bound):
+                    print('LDA model converged after ' + str(n + 1) +
+                            ' passes')
+                    break
+                bound = new_bound
+        return lda
+
+    def get_topics(self):
+        '''
+        Get most probable words of each topic.
+        '''
+        topics = [t[1] for t in self.lda.show_topics(num_words=self.num_words,
+            num_topics=self.num_topics, formatted=False)]
+        return [[(i[1], i[0]) for i in t] for t in topics]
+
+    def update(self, corpus):
+        '''
+        Update LDA model with corpus of new documents.
+        '''
+        with self.doc_reader.metrics.stage('topics'):
+            if self.mallet_path:
+                # Mallet models can't be updated, train on the full corpus
+                self.lda = self.get_model()
+            elif corpus:
+                # Tokens new to the dictionary are unknown to the model
+                print('Updating Gensim LDA model ...')
+                num_terms = self.lda.num_terms
+                self.lda.update([[(i, n) for i, n in bow if i < num_terms] for
+                        bow in corpus])
+            self.topics = self.get_topics()
 
     def save_topics(self, dir_name):
         '''
@@ -87,5 +291,6 @@ class TfIdfList(object):
         self.doc_reader = doc_reader
 
         print('Generating Gensim TF-IDF model ...')
-        tfidf = gensim.models.TfidfModel(self.doc_reader.corpus)
+        with self.doc_reader.metrics.stage('tf-idf'):
+            tfidf = gensim.models.TfidfModel(self.doc_reader.corpus)
         self.scores = tfidf[self.doc_reader.corpus]
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Frame Generator
+#
+# Copyright (C) 2016 Juliette Lonij, Koninklijke Bibliotheek -
+# National Library of the Netherlands
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import time
+import unicodecsv as csv
+
+UNWANTED_CHARS = [u'&', u'/', u'|', u'_', u':', u'=', u'(', u')', u'[', u']']
+REGEX_CHARS = set('.^$*+?{}[]\\|()')
+
+
+def is_literal(regex):
+    '''
+    Check if regular expression and replacement are plain strings.
+    '''
+    return not (set(regex[0]) & REGEX_CHARS) and '\\' not in regex[1]
+
+
+def overlaps(a, b):
+    '''
+    Check if two strings overlap when placed next to each other.
+    '''
+    a = a.lower()
+    b = b.lower()
+    if a in b or b in a:
+        return True
+    for i in range(1, min(len(a), len(b))):
+        if a.endswith(b[:i]) or b.endswith(a[:i]):
+            return True
+    return False
+
+
+def trie_pattern(words):
+    '''
+    Create regular expression matching any of the words from a trie.
+    '''
+    trie = {}
+    for w in words:
+        node = trie
+        for char in w:
+            node = node.setdefault(char, {})
+    return _node_pattern(trie)
+
+
+def _node_pattern(node):
+    alternatives = [re.escape(char) + _node_pattern(child) for char, child in
+            sorted(node.items())]
+    if len(alternatives) > 1:
+        return '(?:' + '|'.join(alternatives) + ')'
+    return ''.join(alternatives)
+
+
+class Normalizer(object):
+    '''
+    Apply regular expressions and remove unwanted characters.
+    '''
+
+    def __init__(self, regex_list):
+        '''
+        Compile regular expressions into replacement passes.
+        '''
+        self.regex_list = regex_list
+        self.hits = [0] * len(regex_list)
+        self.passes = self.get_passes(regex_list)
+        self.times = [0.0] * len(self.passes)
+        self.unwanted_chars = dict((ord(c), None) for c in UNWANTED_CHARS)
+
+    def __getstate__(self):
+        # Replacement functions can't be pickled, compile passes again
+        state = self.__dict__.copy()
+        del state['passes']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.passes = self.get_passes(self.regex_list)
+
+    def get_passes(self, regex_list):
+        '''
+        Group regular expressions into compiled replacement passes.
+        '''
+        # Merge runs of literal expressions that cannot interact, so
+        # applying them in one pass equals applying them one by one
+        groups = []
+        for i, regex in enumerate(regex_list):
+            if groups and is_literal(regex) and all(
+                    is_literal(regex_list[j]) and regex_list[j][1] and not
+                    overlaps(regex_list[j][0], regex[0]) and not
+                    overlaps(regex_list[j][1], regex[0]) for j in
+                    groups[-1]):
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+
+        passes = []
+        for group in groups:
+            if len(group) == 1 and not is_literal(regex_list[group[0]]):
+                regex = regex_list[group[0]]
+                passes.append((group, re.compile(regex[0], flags=re.I),
+                        regex[1]))
+            else:
+                pattern = trie_pattern([regex_list[i][0] for i in group])
+                passes.append((group, re.compile(pattern, flags=re.I),
+                        self.get_replacer(group)))
+        return passes
+
+    def normalize(self, doc):
+        '''
+        Normalize document text.
+        '''
+        # Process user provided regular expressions
+        for n, (group, regex, replacement) in enumerate(self.passes):
+            start = time.time()
+            doc, hits = regex.subn(replacement, doc)
+            if not callable(replacement):
+                self.hits[group[0]] += hits
+            self.times[n] += time.time() - start
+
+        # Remove unwanted characters and whitespace
+        doc = doc.translate(self.unwanted_chars)
+        return ' '.join(doc.split())
+
+    def get_replacer(self, group):
+        '''
+        Create function replacing matches of literal expressions.
+        '''
+        replacements = dict((self.regex_list[i][0].lower(), i) for i in group)
+
+        def replace(match):
+            i = replacements[match.group(0).lower()]
+            self.hits[i] += 1
+            return self.regex_list[i][1]
+
+        return replace
+
+    def reset_stats(self):
+        '''
+        Reset hit counts and processing time of expressions.
+        '''
+        self.hits = [0] * len(self.hits)
+        self.times = [0.0] * len(self.times)
+
+    def add_stats(self, hits, times):
+        '''
+        Add hit counts and processing time from another normalizer.
+        '''
+        self.hits = [a + b for a, b in zip(self.hits, hits)]
+        self.times = [a + b for a, b in zip(self.times, times)]
+
+    def save_stats(self, dir_name):
+        '''
+        Save hit counts and processing time of expressions to file.
+        '''
+        with open(dir_name + os.sep + 'regex' + '.csv', 'wb') as f:
+            # Manually encode a BOM, utf-8-sig didn't work with unicodecsv
+            f.write(u'\ufeff'.encode('utf8'))
+            csv_writer = csv.writer(f, delimiter='\t', encoding='utf-8')
+            for n, (group, regex, replacement) in enumerate(self.passes):
+                for i in group:
+                    csv_writer.writerow(self.regex_list[i] + [str(n + 1),
+                            str(self.hits[i]), str(self.times[n])])
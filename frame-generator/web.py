@@ -19,97 +19,440 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+import cache
+import errno
 import generator
+import hashlib
+import importlib
 import json
+import multiprocessing
 import os
+import random
+import re
 import shutil
+import signal
+import sys
 import time
+import uuid
 
+from bottle import default_app
 from bottle import post
 from bottle import request
+from bottle import response
 from bottle import route
 from bottle import run
+from multiprocessing.managers import BaseManager
+from wsgiref.simple_server import WSGIServer
+from wsgiref.simple_server import make_server
 
+ABS_PATH = os.path.dirname(os.path.realpath(__file__))
+JOB_DIR = ABS_PATH + os.sep + 'jobs'
+
+# Number of jobs processed at the same time
+JOB_WORKERS = 2
+
+# Maximum number of queued and running jobs
+MAX_JOBS = 10
+
+# Seconds job results are kept
+JOB_TTL = 24 * 60 * 60
+
+# Maximum size of cached results in bytes
+RESULT_CACHE_SIZE = 64 * 2 ** 20
+
+# Fraction of requests profiled, each in its own directory in PROFILE_DIR
+PROFILE_RATE = 0.0
+PROFILE_DIR = ABS_PATH + os.sep + 'profiles'
+
+_pool = None
+_pool_pid = None
+
+# Modules imported before forking worker processes, so workers share them
+PRELOAD_MODULES = ['generator', 'gensim', 'segtok.segmenter',
+        'segtok.tokenizer', 'lxml.etree', 'scipy.sparse']
+
+result_cache = cache.ResultCache(RESULT_CACHE_SIZE)
+
+
+class CacheManager(BaseManager):
+    '''
+    Server process holding the result cache shared by prefork workers.
+    '''
+
+CacheManager.register('get_result_cache', callable=lambda: result_cache)
+
+
+def get_pool():
+    '''
+    Get job worker pool of the current process.
+    '''
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        _pool = multiprocessing.Pool(JOB_WORKERS)
+        _pool_pid = os.getpid()
+    return _pool
+
+def get_uploads():
+    '''
+    Get uploaded files and generator parameters from request.
+    '''
+    # Files are passed to the generator in memory, see get_source
+    inputs = {'docs': {}, 'stop': {}, 'regex': {}}
+    doc_files = request.files.getall('doc_files[]')
+    for f in doc_files:
+        name, ext = os.path.splitext(f.filename)
+        if ext in ['.txt', '.json', '.xml']:
+            inputs['docs'][f.filename] = f.file.read()
+
+    stop_files = request.files.getall('stop_files[]')
+    for f in stop_files:
+        name, ext = os.path.splitext(f.filename)
+        if ext == '.txt':
+            inputs['stop'][f.filename] = f.file.read()
+
+    regex_files = request.files.getall('regex_files[]')
+    for f in regex_files:
+        name, ext = os.path.splitext(f.filename)
+        if ext == '.txt':
+            inputs['regex'][f.filename] = f.file.read()
+
+    window_size = int(request.forms.get('window_size'))
+    window_direction = request.forms.get('window_direction')
+
+    frame_tags = []
+    for i in range(1, 13):
+        if request.forms.get('ftag' + str(i)):
+            frame_tags.append(request.forms.get('ftag' + str(i)))
+
+    keyword_tags = []
+    for i in range(1, 13):
+        if request.forms.get('ktag' + str(i)):
+            keyword_tags.append(request.forms.get('ktag' + str(i)))
+
+    params = {'dlen': 10, 'kcount': 5, 'ktags': keyword_tags,
+            'wdir': window_direction, 'wsize': window_size,
+            'ftags': frame_tags, 'fsize': 8}
+    return inputs, params
+
+def get_result_key(inputs, params):
+    '''
+    Get hash of uploaded files and generator parameters.
+    '''
+    return hashlib.sha1(cache.hash_files(inputs) + json.dumps(params,
+            sort_keys=True)).hexdigest()
+
+def generate(inputs, params):
+    '''
+    Generate requested frames, return them as json string and the metrics
+    of the run.
+    '''
+    profile = False
+    if random.random() < PROFILE_RATE:
+        profile = PROFILE_DIR + os.sep + time.strftime('%Y%m%d%H%M%S') + \
+                '-' + uuid.uuid4().hex[:8]
+
+    # Uploads are not cached on disk, results are cached in memory
+    _, keyword_list, frame_list = generator.generate(input_dir=inputs,
+            output_dir=None, cache_dir=None, profile=profile, **params)
+
+    max_kscore = max([k[1] for k in keyword_list.keywords])
+    max_fscores = []
+    for frame in frame_list.frames:
+        if frame:
+            max_fscores.append(max([f[1] for f in frame]))
+    max_fscore = max(max_fscores)
+
+    data = {'frames': []}
+    for i, k in enumerate(keyword_list.keywords):
+        d = {}
+        d['keyword'] = {k[0].encode('utf-8'): k[1] / max_kscore}
+        d['frame'] = {}
+        for f in frame_list.frames[i]:
+            d['frame'][f[0].encode('utf-8')] = f[1] / max_fscore
+        data['frames'].append(d)
+
+    return json.dumps(data), keyword_list.doc_reader.metrics.get_metrics()
+
+def add_metrics(result, metrics):
+    '''
+    Add metrics of the run to json result. Cached results are stored
+    without them, as they describe the run that created the result.
+    '''
+    return result[:-1] + ', "metrics": ' + json.dumps(metrics) + '}'
+
+def write_file(path, data):
+    '''
+    Write file at once, so readers never see partial data.
+    '''
+    with open(path + '.tmp', 'w') as f:
+        f.write(data)
+    os.rename(path + '.tmp', path)
+
+def set_status(job_dir, status):
+    '''
+    Save status of job, with the process that is to finish it.
+    '''
+    write_file(job_dir + os.sep + 'status.json', json.dumps({'status':
+            status, 'pid': os.getpid()}))
+
+def is_alive(pid):
+    '''
+    Check if process exists.
+    '''
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def get_status(job_dir):
+    '''
+    Get status of job, None if job doesn't exist.
+    '''
+    try:
+        with open(job_dir + os.sep + 'status.json') as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    # Fail jobs whose process exited before finishing them, e.g. after a
+    # restart or crash
+    if data['status'] in ['queued', 'running'] and not is_alive(
+            data.get('pid')):
+        write_file(job_dir + os.sep + 'result.json', json.dumps({'error':
+                'Job interrupted'}))
+        set_status(job_dir, 'error')
+        return 'error'
+    return data['status']
+
+def run_job(job_dir, inputs, params):
+    '''
+    Run job in worker process and save result.
+    '''
+    set_status(job_dir, 'running')
+    try:
+        result, metrics = generate(inputs, params)
+        status = 'done'
+        write_file(job_dir + os.sep + 'result.json', add_metrics(result,
+                metrics))
+    except Exception as e:
+        result = json.dumps({'error': repr(e)})
+        status = 'error'
+        write_file(job_dir + os.sep + 'result.json', result)
+    set_status(job_dir, status)
+    return result if status == 'done' else None
+
+def clean_jobs():
+    '''
+    Remove expired jobs and count queued and running jobs.
+    '''
+    num_jobs = 0
+    for job_id in os.listdir(JOB_DIR):
+        job_dir = JOB_DIR + os.sep + job_id
+        if time.time() - os.path.getmtime(job_dir) > JOB_TTL:
+            shutil.rmtree(job_dir, ignore_errors=True)
+        elif get_status(job_dir) in ['queued', 'running']:
+            num_jobs += 1
+    return num_jobs
+
+def get_job_dir(job_id):
+    '''
+    Get directory of job, None for invalid job ids.
+    '''
+    if not re.match('^[0-9a-f]{32}$', job_id):
+        return None
+    return JOB_DIR + os.sep + job_id
 
 @post('/')
 def index():
     '''
     Generate requested frames and return as json response.
+
+    Kept for existing clients, new clients should use /jobs, which doesn't
+    keep a worker waiting for the response.
     '''
     try:
-        abs_path = os.path.dirname(os.path.realpath(__file__))
-        input_dir = abs_path + os.sep + 'input' + os.sep + str(int(time.time()))
-        os.makedirs(input_dir)
-
-        doc_dir = input_dir + os.sep + 'docs'
-        os.makedirs(doc_dir)
-        doc_files = request.files.getall('doc_files[]')
-        for f in doc_files:
-            name, ext = os.path.splitext(f.filename)
-            if ext in ['.txt', '.json', '.xml']:
-                f.save(doc_dir)
-
-        stop_dir = input_dir + os.sep + 'stop'
-        os.makedirs(stop_dir)
-        stop_files = request.files.getall('stop_files[]')
-        for f in stop_files:
-            name, ext = os.path.splitext(f.filename)
-            if ext == '.txt':
-                f.save(stop_dir)
-
-        regex_dir = input_dir + os.sep + 'regex'
-        os.makedirs(regex_dir)
-        regex_files = request.files.getall('regex_files[]')
-        for f in regex_files:
-            name, ext = os.path.splitext(f.filename)
-            if ext == '.txt':
-                f.save(regex_dir)
-
-        window_size = int(request.forms.get('window_size'))
-        window_direction = request.forms.get('window_direction')
-
-        frame_tags = []
-        for i in range(1, 13):
-            if request.forms.get('ftag' + str(i)):
-                frame_tags.append(request.forms.get('ftag' + str(i)))
-
-        keyword_tags = []
-        for i in range(1, 13):
-            if request.forms.get('ktag' + str(i)):
-                keyword_tags.append(request.forms.get('ktag' + str(i)))
-
-        _, keyword_list, frame_list = generator.generate(dlen=10, kcount=5,
-                ktags=keyword_tags, wdir=window_direction, wsize=window_size,
-                ftags=frame_tags, input_dir=input_dir, output_dir=None, fsize=8)
-
-        max_kscore = max([k[1] for k in keyword_list.keywords])
-        max_fscores = []
-        for frame in frame_list.frames:
-            if frame:
-                max_fscores.append(max([f[1] for f in frame]))
-        max_fscore = max(max_fscores)
-
-        data = {'frames': []}
-        for i, k in enumerate(keyword_list.keywords):
-            d = {}
-            d['keyword'] = {k[0].encode('utf-8'): k[1] / max_kscore}
-            d['frame'] = {}
-            for f in frame_list.frames[i]:
-                d['frame'][f[0].encode('utf-8')] = f[1] / max_fscore
-            data['frames'].append(d)
-
-        result = json.dumps(data)
+        inputs, params = get_uploads()
+        key = get_result_key(inputs, params)
+        result = result_cache.get(key)
+        if result is None:
+            result, metrics = generate(inputs, params)
+            result_cache.put(key, result)
+            result = add_metrics(result, metrics)
 
     except Exception as e:
         result = json.dumps({'error': repr(e)})
 
-    finally:
-        if 'input_dir' in locals():
-            if os.path.isdir(input_dir):
-                shutil.rmtree(input_dir)
-
     print result
     return result
 
+@post('/jobs')
+def submit_job():
+    '''
+    Queue job generating requested frames and return job id.
+    '''
+    response.content_type = 'application/json'
+    if not os.path.isdir(JOB_DIR):
+        os.makedirs(JOB_DIR)
+    if clean_jobs() >= MAX_JOBS:
+        response.status = 503
+        return json.dumps({'error': 'Too many jobs, try again later'})
+
+    try:
+        inputs, params = get_uploads()
+    except Exception as e:
+        response.status = 400
+        return json.dumps({'error': repr(e)})
+
+    job_id = uuid.uuid4().hex
+    job_dir = JOB_DIR + os.sep + job_id
+    os.makedirs(job_dir)
+
+    # Finish job right away if the result is cached
+    key = get_result_key(inputs, params)
+    result = result_cache.get(key)
+    if result is not None:
+        write_file(job_dir + os.sep + 'result.json', result)
+        set_status(job_dir, 'done')
+        response.status = 202
+        return json.dumps({'job': job_id, 'status': 'done'})
+
+    set_status(job_dir, 'queued')
+    get_pool().apply_async(run_job, (job_dir, inputs, params),
+            callback=lambda result: result and result_cache.put(key, result))
+    response.status = 202
+    return json.dumps({'job': job_id, 'status': 'queued'})
+
+@route('/jobs/<job_id>')
+def job_status(job_id):
+    '''
+    Return status of job: queued, running, done or error.
+    '''
+    response.content_type = 'application/json'
+    job_dir = get_job_dir(job_id)
+    status = get_status(job_dir) if job_dir else None
+    if not status:
+        response.status = 404
+        return json.dumps({'error': 'Job not found'})
+    return json.dumps({'job': job_id, 'status': status})
+
+@route('/jobs/<job_id>/result')
+def job_result(job_id):
+    '''
+    Return result of finished job as json response.
+    '''
+    response.content_type = 'application/json'
+    job_dir = get_job_dir(job_id)
+    status = get_status(job_dir) if job_dir else None
+    if not status:
+        response.status = 404
+        return json.dumps({'error': 'Job not found'})
+    if status not in ['done', 'error']:
+        response.status = 202
+        return json.dumps({'job': job_id, 'status': status})
+    with open(job_dir + os.sep + 'result.json') as f:
+        return f.read()
+
+@route('/stats')
+def stats():
+    '''
+    Return result cache statistics as json response.
+    '''
+    response.content_type = 'application/json'
+    return json.dumps({'result_cache': result_cache.get_stats()})
+
+class PreforkServer(WSGIServer):
+    '''
+    WSGI server whose listening socket is shared by forked workers.
+    '''
+    request_queue_size = 128
+
+def run_worker(server, max_requests, manager):
+    '''
+    Handle requests in forked worker process, then exit.
+    '''
+    global result_cache
+    result_cache = manager.get_result_cache()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        num_requests = 0
+        while not max_requests or num_requests < max_requests:
+            server.handle_request()
+            num_requests += 1
+        # Finish queued jobs before exiting
+        if _pool_pid == os.getpid():
+            _pool.close()
+            _pool.join()
+    except SystemExit:
+        if _pool_pid == os.getpid():
+            _pool.terminate()
+    finally:
+        os._exit(0)
+
+def serve(host='localhost', port=8091, workers=4, max_requests=1000):
+    '''
+    Serve with prefork worker processes, replacing each worker after
+    max_requests requests.
+    '''
+    for name in PRELOAD_MODULES:
+        importlib.import_module(name)
+    server = make_server(host, port, default_app(),
+            server_class=PreforkServer)
+
+    # Workers share one result cache, kept in a separate process
+    manager = CacheManager()
+    manager.start(lambda: signal.signal(signal.SIGINT, signal.SIG_IGN))
+
+    children = set()
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        manager.shutdown()
+        sys.exit()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    print('Serving on http://' + host + ':' + str(port) + '/ with ' +
+            str(workers) + ' workers ...')
+    while True:
+        while len(children) < workers:
+            pid = os.fork()
+            if not pid:
+                run_worker(server, max_requests, manager)
+            children.add(pid)
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        children.discard(pid)
+
 if __name__ == '__main__':
-    run(host='localhost', port=8091)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', required=False, type=str,
+            default='localhost', help='host name')
+    parser.add_argument('--port', required=False, type=int, default=8091,
+            help='port number')
+    parser.add_argument('--workers', required=False, type=int, default=4,
+            help='number of prefork worker processes, 0 for the ' +
+            'single-process development server')
+    parser.add_argument('--max-requests', required=False, type=int,
+            default=1000, help='requests handled by a worker before it is ' +
+            'replaced, 0 for no limit')
+    parser.add_argument('--profile-rate', required=False, type=float,
+            default=PROFILE_RATE, help='fraction of requests to profile')
+    args = parser.parse_args()
+    PROFILE_RATE = args.profile_rate
+
+    if args.workers:
+        serve(args.host, args.port, args.workers, args.max_requests)
+    else:
+        run(host=args.host, port=args.port)
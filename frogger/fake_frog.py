@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Stand-in for a Frog server (frog -S <port>), for testing throughput of the
+# wrapper without a real Frog installation. Answers with Frog's 10 column
+# output format, using fake lemmas and tags.
+
+import argparse
+import SocketServer
+import time
+import zlib
+
+TAGS = ['N(soort,ev,basis,zijd,stan)', 'WW(pv,tgw,ev)', 'ADJ(prenom,basis)',
+        'VZ(init)', 'LID(bep,stan,rest)', 'VNW(pers,pron,nomin)', 'BW()',
+        'VG(neven)']
+
+class FrogHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        # Keep connection open for multiple requests, like Frog does
+        while True:
+            lines = []
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                if line.strip() == 'EOT':
+                    break
+                lines.append(line.decode('utf-8'))
+
+            if self.server.delay:
+                time.sleep(self.server.delay)
+
+            out = []
+            for line in lines:
+                words = line.split()
+                for i, word in enumerate(words):
+                    tag = TAGS[zlib.crc32(word.encode('utf-8')) % len(TAGS)]
+                    out.append('\t'.join([str(i + 1), word, word.lower(),
+                            '[' + word.lower() + ']', tag, '0.9', 'O', 'O',
+                            '0', 'ROOT']))
+                if words:
+                    out.append('')
+            out.append('READY')
+            self.wfile.write(('\n'.join(out) + '\n').encode('utf-8'))
+
+class FrogServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run fake Frog server')
+    parser.add_argument('--port', type=int, default=4096)
+    parser.add_argument('--delay', type=float, default=0.0,
+            help='seconds to wait before each response')
+    args = parser.parse_args()
+
+    server = FrogServer(('', args.port), FrogHandler)
+    server.delay = args.delay
+    print 'Fake Frog listening on port ' + str(args.port)
+    server.serve_forever()
@@ -2,64 +2,254 @@
 # -*- coding: utf-8 -*-
 
 
+import json
+import os
 import socket
+import threading
+import time
 import urllib
+import zlib
 
-from flask import Flask, request
+from flask import Flask, Response, request
+from multiprocessing.pool import ThreadPool
 
 application = Flask(__name__)
 application.debug = True
 
+# Comma separated host:port list of Frog servers
+FROG_BACKENDS = os.environ.get('FROG_BACKENDS', 'ontw:4096')
+
+# Seconds to wait for a connection when checking a Frog server's health
+HEALTH_TIMEOUT = 2.0
+
 class Frog():
-    def __init__(self, port=4096):
-        self.BUFSIZE = 4096
+    def __init__(self, port=4096, host='ontw'):
+        self.BUFSIZE = 65536
+        self.host = host
         self.port = port
+        self.socket = None
 
-    def tag(self, text, html=False):
+    def connect(self, timeout=120.0):
         self.socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        self.socket.settimeout(120.0)
-        self.socket.connect(('ontw', self.port))
-
-        text = text.strip(' \t\n')
-        text = text.encode('utf-8') + b'\r\nEOT\r\n'
-        self.socket.sendall(text)
-
-        res = ''
-        done = False
-        while not done:
-            data = b''
-            while not data or data[-1] != b'\n':
+        self.socket.settimeout(timeout)
+        self.socket.connect((self.host, self.port))
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def tag(self, text, html=False, keep_alive=False):
+        if not self.socket:
+            self.connect()
+
+        try:
+            text = text.strip(' \t\n')
+            text = text.encode('utf-8') + b'\r\nEOT\r\n'
+            self.socket.sendall(text)
+
+            # Collect chunks until Frog sends a READY line
+            chunks = []
+            tail = b''
+            while True:
                 more = self.socket.recv(self.BUFSIZE)
                 if not more:
+                    raise socket.error('Connection closed by Frog')
+                chunks.append(more)
+                tail = (tail + more)[-64:]
+                if (tail.endswith(b'\n') and
+                        tail.strip(b' \t\r\n').split(b'\n')[-1].strip() ==
+                        b'READY'):
                     break
-                data += more
-            for line in data.strip(' \t\r\n').split('\n'):
-                if line.strip() == 'READY':
-                    done = True
-                elif line:
-                    res += line + "\n"
+        except:
+            self.close()
+            raise
+
+        if not keep_alive:
+            self.close()
+
+        data = b''.join(chunks).strip(' \t\r\n')
+        return ''.join([line + '\n' for line in data.split('\n') if line and
+                line.strip() != 'READY'])
+
+class FrogBackend():
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.outstanding = 0
+        self.healthy = True
+        self.failed_at = 0
+
+class FrogPool():
+    '''
+    Persistent connections to one or more Frog servers.
+
+    Requests go to the healthy backend with the fewest outstanding
+    requests. Failed backends are retried after retry_interval seconds.
+    '''
+
+    def __init__(self, backends, max_idle=8, retry_interval=30.0):
+        self.backends = []
+        for backend in backends.split(','):
+            host, port = backend.strip().rsplit(':', 1)
+            self.backends.append(FrogBackend(host, int(port)))
+        self.max_idle = max_idle
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
 
-        self.socket.close()
-        return res
+    def acquire(self, exclude):
+        with self.lock:
+            now = time.time()
+            remaining = [b for b in self.backends if b not in exclude]
+            candidates = [b for b in remaining if b.healthy or
+                    now - b.failed_at > self.retry_interval]
+            # Rather try a failed backend again than fail the request
+            if not candidates:
+                candidates = remaining
+            if not candidates:
+                return None, None
+            backend = min(candidates, key=lambda b: b.outstanding)
+            backend.outstanding += 1
+            if backend.idle:
+                return backend, backend.idle.pop()
+        return backend, Frog(backend.port, backend.host)
+
+    def release(self, backend, frog, failed=False):
+        with self.lock:
+            backend.outstanding -= 1
+            if failed:
+                backend.healthy = False
+                backend.failed_at = time.time()
+                for idle_frog in backend.idle:
+                    idle_frog.close()
+                backend.idle = []
+            else:
+                backend.healthy = True
+                if len(backend.idle) < self.max_idle:
+                    backend.idle.append(frog)
+                    return
+        frog.close()
+
+    def tag(self, text):
+        tried = []
+        while True:
+            backend, frog = self.acquire(tried)
+            if not backend:
+                raise socket.error('No Frog backend available')
+            tried.append(backend)
+            try:
+                result, frog = self.tag_backend(backend, frog, text)
+            except socket.error:
+                self.release(backend, frog, failed=True)
+                continue
+            except:
+                # Release the backend, with the connection closed
+                frog.close()
+                self.release(backend, frog)
+                raise
+            self.release(backend, frog)
+            return result
+
+    def tag_backend(self, backend, frog, text):
+        # An idle connection may have been closed by a restarted Frog
+        # server, retry once on a new connection before giving up
+        if frog.socket:
+            try:
+                return frog.tag(text, keep_alive=True), frog
+            except socket.timeout:
+                raise
+            except socket.error:
+                frog = Frog(backend.port, backend.host)
+        return frog.tag(text, keep_alive=True), frog
+
+    def check(self):
+        status = {}
+        for backend in self.backends:
+            frog = Frog(backend.port, backend.host)
+            try:
+                frog.connect(HEALTH_TIMEOUT)
+                healthy = True
+            except socket.error:
+                healthy = False
+            frog.close()
+            with self.lock:
+                backend.healthy = healthy
+                if not healthy:
+                    backend.failed_at = time.time()
+            status[backend.host + ':' + str(backend.port)] = {
+                    'healthy': healthy, 'outstanding': backend.outstanding,
+                    'idle': len(backend.idle)}
+        return status
+
+pool = FrogPool(FROG_BACKENDS)
+workers = None
+
+def get_workers():
+    global workers
+    # Concurrent first requests must not create several pools
+    with pool.lock:
+        if not workers:
+            workers = ThreadPool(len(pool.backends) * 2)
+    return workers
+
+def tag_compact(text):
+    # One lemma<TAB>main tag line per token, an empty line ends the document
+    try:
+        data = pool.tag(text)
+    except socket.error:
+        return '!not found\n\n'
+    tokens = [line.split('\t') for line in data.split('\n') if line]
+    if not tokens:
+        return '!not found\n\n'
+    if len(tokens[0]) != 10:
+        return '!invalid\n\n'
+    return ''.join([t[2] + '\t' + t[4].split('(')[0] + '\n' for t in tokens
+            if len(t) == 10]) + '\n'
 
 @application.route('/')
 def index():
     url = request.args.get('url')
     text = request.args.get('text')
 
-    frog = Frog()
     if url:
         data = urllib.urlopen(url).read().decode('utf-8')
         data = data.replace('<text>', '').replace('</text>','')
         data = data.replace('<title>','').replace('</title>','.')
         data = data.replace('<p>','').replace('</p>','')
-        return frog.tag(data)
+        return pool.tag(data)
 
     if text:
-        return frog.tag(text)
+        return pool.tag(text)
 
     return ('No input recieved, either use ?url= or ?text=')
 
+@application.route('/batch', methods=['POST'])
+def batch():
+    data = request.get_data()
+    if request.headers.get('Content-Encoding') == 'gzip':
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    docs = json.loads(data.decode('utf-8'))['docs']
+    texts = [' '.join(doc) if isinstance(doc, list) else doc for doc in docs]
+
+    gzipped = 'gzip' in request.headers.get('Accept-Encoding', '')
+    def generate():
+        if gzipped:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for result in get_workers().imap(tag_compact, texts):
+            yield compressor.compress(result) if gzipped else result
+        if gzipped:
+            yield compressor.flush()
+
+    headers = {'Content-Encoding': 'gzip'} if gzipped else {}
+    return Response(generate(), mimetype='text/plain', headers=headers)
+
+@application.route('/health')
+def health():
+    status = pool.check()
+    code = 200 if any(s['healthy'] for s in status.values()) else 503
+    return json.dumps(status), code, {'Content-Type': 'application/json'}
+
 if __name__ == "__main__":
 
     a="""
@@ -72,4 +262,3 @@ if __name__ == "__main__":
 
     f = Frog()
     print f.tag(a.decode('utf-8'))
-